@@ -0,0 +1,362 @@
+"""Local stand-ins for LM Studio and AnkiConnect, with configurable latency and error injection"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FaultInjector:
+    """Latency and failure settings shared by the handlers of a fake server"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, capacity=None):
+        """
+        Args:
+            latency: Mean seconds added to every request
+            jitter: Maximum seconds randomly added to or removed from the latency
+            error_rate: Fraction of requests answered with an HTTP 500
+            seed: Seed for reproducible latencies and failures
+            capacity: Number of requests served in parallel at full speed; beyond it the
+                latency grows with the number in flight, like a saturated GPU (None = unlimited)
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            offset = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            slowdown = max(1.0, self.in_flight / self.capacity) if self.capacity else 1.0
+        time.sleep(max(0.0, self.latency + offset) * slowdown)
+        with self._lock:
+            self.in_flight -= 1
+        return fail
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    faults = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def fake_card(word):
+    """Deterministic card text in the format prompt.template asks for"""
+    return (
+        f"German: {word}\n"
+        f"English: translation of {word}\n"
+        f"Example 1 (DE): Das ist ein formeller Satz mit {word}.\n"
+        f"Example 1 (EN): This is a formal sentence with {word}.\n"
+        f"Example 2 (DE): Hier ist noch ein Satz mit {word}.\n"
+        f"Example 2 (EN): Here is another sentence with {word}."
+    )
+
+
+class FakePromptCache:
+    """
+    Single-slot prompt cache like llama.cpp's: only the part of a prompt that differs from
+    the previous prompt has to be processed again
+    """
+
+    def __init__(self, seconds_per_char=0.0):
+        """
+        Args:
+            seconds_per_char: Simulated prompt processing time per uncached prompt character
+        """
+        self.seconds_per_char = seconds_per_char
+        self._last = ""
+        self._lock = threading.Lock()
+
+    def prefill_time(self, prompt):
+        with self._lock:
+            cached = len(os.path.commonprefix([self._last, prompt]))
+            self._last = prompt
+        return (len(prompt) - cached) * self.seconds_per_char
+
+
+class FakeLLMHandler(_Handler):
+    """OpenAI-compatible /v1/chat/completions answering with well-formed cards"""
+
+    prompt_cache = None
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send(200, {"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.faults.delay():
+            self._send(500, {"error": {"message": "injected failure"}})
+            return
+
+        if self.prompt_cache is not None:
+            rendered = "".join(f"<|{m['role']}|>{m['content']}" for m in body["messages"])
+            time.sleep(self.prompt_cache.prefill_time(rendered))
+
+        prompt = body["messages"][1]["content"] if len(body["messages"]) > 1 else body["messages"][-1]["content"]
+        single = re.search(r"card for the word: (.+)$", prompt, re.MULTILINE)
+        if single:
+            text = fake_card(single.group(1).strip())
+        else:
+            words = re.findall(r"^\d+\. (.+)$", prompt, re.MULTILINE)
+            text = "\n\n".join(f"Card {i}\n{fake_card(word.strip())}" for i, word in enumerate(words, 1))
+
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+        completion_tokens = len(text) // 4
+        if body.get("stream"):
+            self._stream(body, text)
+            return
+        self._send(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake-model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _stream(self, body, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i in range(0, len(text), 8):
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "fake-model"),
+                    "choices": [{"index": 0, "delta": {"content": text[i:i + 8]}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up early, which is what streaming mode is supposed to do
+            pass
+
+
+class FakeAnkiState:
+    """In-memory decks, models and notes behind the fake AnkiConnect"""
+
+    def __init__(self):
+        self.decks = {"Default"}
+        self.deck_ids = {}
+        self.models = {}
+        self.notes = {}
+        self.media = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _matches(self, note, query):
+        for key, value in re.findall(r'"(\w+):([^"]*)"', query):
+            if key == "deck" and note["deckName"] != value:
+                return False
+            if key == "note" and note["modelName"] != value:
+                return False
+            if key not in ("deck", "note") and note["fields"].get(key, "").lower() != value.lower():
+                return False
+        return True
+
+    def _is_duplicate(self, note):
+        word = note["fields"].get("Word", "")
+        return any(
+            existing["deckName"] == note["deckName"] and existing["fields"].get("Word") == word
+            for existing in self.notes.values()
+        )
+
+    def _add(self, note):
+        if not note.get("options", {}).get("allowDuplicate") and self._is_duplicate(note):
+            raise ValueError("cannot create note because it is a duplicate")
+        note_id = self._next_id
+        self._next_id += 1
+        self.notes[note_id] = {
+            "deckName": note["deckName"],
+            "modelName": note["modelName"],
+            "fields": dict(note["fields"]),
+            "tags": list(note.get("tags", [])),
+        }
+        return note_id
+
+    def invoke(self, action, params):
+        with self._lock:
+            if action == "version":
+                return 6
+            if action == "deckNames":
+                return sorted(self.decks)
+            if action == "deckNamesAndIds":
+                return {name: self.deck_ids.setdefault(name, 1500000000000 + len(self.deck_ids)) for name in sorted(self.decks)}
+            if action == "createDeck":
+                self.decks.add(params["deck"])
+                return len(self.decks)
+            if action == "modelNames":
+                return sorted(self.models)
+            if action == "modelFieldNames":
+                return self.models[params["modelName"]]
+            if action == "createModel":
+                self.models[params["modelName"]] = list(params["inOrderFields"])
+                return {"name": params["modelName"]}
+            if action == "findNotes":
+                return [note_id for note_id, note in self.notes.items() if self._matches(note, params.get("query", ""))]
+            if action == "notesInfo":
+                return [
+                    {
+                        "noteId": note_id,
+                        "modelName": self.notes[note_id]["modelName"],
+                        "tags": self.notes[note_id]["tags"],
+                        "fields": {
+                            name: {"value": value, "order": order}
+                            for order, (name, value) in enumerate(self.notes[note_id]["fields"].items())
+                        },
+                    }
+                    for note_id in params["notes"] if note_id in self.notes
+                ]
+            if action == "canAddNotes":
+                return [not self._is_duplicate(note) for note in params["notes"]]
+            if action == "addNote":
+                return self._add(params["note"])
+            if action == "addNotes":
+                results = []
+                for note in params["notes"]:
+                    try:
+                        results.append(self._add(note))
+                    except ValueError:
+                        results.append(None)
+                return results
+            if action == "updateNoteFields":
+                self.notes[params["note"]["id"]]["fields"].update(params["note"]["fields"])
+                return None
+            if action in ("addTags", "removeTags"):
+                for note_id in params["notes"]:
+                    tags = self.notes[note_id]["tags"]
+                    for tag in params["tags"].split():
+                        if action == "addTags" and tag not in tags:
+                            tags.append(tag)
+                        elif action == "removeTags" and tag in tags:
+                            tags.remove(tag)
+                return None
+            if action == "deleteNotes":
+                for note_id in params["notes"]:
+                    self.notes.pop(note_id, None)
+                return None
+            if action == "storeMediaFile":
+                self.media[params["filename"]] = params.get("data") or params.get("path") or params.get("url")
+                return params["filename"]
+            if action == "getMediaFilesNames":
+                return sorted(self.media)
+            if action == "getMediaDirPath":
+                return None
+            raise ValueError(f"unsupported action: {action}")
+
+
+class FakeAnkiHandler(_Handler):
+    """AnkiConnect version 6 protocol over a FakeAnkiState"""
+
+    state = None
+
+    def _result(self, action, params):
+        if action == "multi":
+            results = []
+            for sub in params.get("actions", []):
+                results.append(self._result(sub["action"], sub.get("params", {})))
+            return {"result": results, "error": None}
+        try:
+            return {"result": self.state.invoke(action, params), "error": None}
+        except (KeyError, ValueError) as e:
+            return {"result": None, "error": str(e)}
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.faults.delay():
+            self._send(500, b"injected failure", content_type="text/plain")
+            return
+        self._send(200, self._result(body.get("action"), body.get("params", {})))
+
+
+class FakeServer:
+    """Runs a fake server on a background thread"""
+
+    def __init__(self, handler, faults, host="127.0.0.1", port=0, **attrs):
+        handler_class = type(handler.__name__, (handler,), dict(faults=faults, **attrs))
+        self.faults = faults
+        self.httpd = ThreadingHTTPServer((host, port), handler_class)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fake_llm_server(faults=None, port=0, prompt_cache=None):
+    """Fake OpenAI-compatible server; its base URL is http://127.0.0.1:<port>/v1"""
+    return FakeServer(FakeLLMHandler, faults or FaultInjector(), port=port, prompt_cache=prompt_cache)
+
+
+def fake_anki_server(faults=None, state=None, port=0):
+    """Fake AnkiConnect server at http://127.0.0.1:<port>"""
+    return FakeServer(FakeAnkiHandler, faults or FaultInjector(), port=port, state=state or FakeAnkiState())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the fake LLM and AnkiConnect servers until interrupted")
+    parser.add_argument("--llm-port", type=int, default=1234)
+    parser.add_argument("--anki-port", type=int, default=8765)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--anki-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-capacity", type=int, help="Concurrent requests the fake LLM serves at full speed")
+    parser.add_argument("--prefill-per-char", type=float, default=0.0, help="Simulated seconds of prompt processing per uncached prompt character")
+    args = parser.parse_args()
+
+    prompt_cache = FakePromptCache(args.prefill_per_char) if args.prefill_per_char else None
+    with fake_llm_server(FaultInjector(args.llm_latency, error_rate=args.error_rate, capacity=args.llm_capacity), port=args.llm_port, prompt_cache=prompt_cache), \
+            fake_anki_server(FaultInjector(args.anki_latency, error_rate=args.error_rate), port=args.anki_port):
+        print(f"Fake LLM on http://127.0.0.1:{args.llm_port}/v1, fake AnkiConnect on http://127.0.0.1:{args.anki_port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,176 @@
+"""
+Microbenchmark and fuzz check for the card parser
+
+The corpus is built from real cards in anki_cards_*.csv: each card is rendered the way
+the model answers and then mutated with the noise models produce (markdown, numbering,
+indentation, CRLF, chatter, a second card) or with damage the parser has to report
+(dropped or emptied fields, truncation, random garbage).
+
+    python -m bench.parser_bench                       # fuzz check + timings
+    python -m bench.parser_bench --write-corpus corpus # also dump the corpus as files
+"""
+import argparse
+import csv
+import glob
+import os
+import random
+import sys
+import timeit
+
+from utils.utils import REQUIRED_KEYS, parse_card, parse_response
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_parse_response(text):
+    """The line-by-line, key-by-key parser parse_card replaced, kept for comparison"""
+    lines = [line.strip() for line in text.split("\n") if line.strip()]
+    data = dict.fromkeys(REQUIRED_KEYS, "")
+    for line in lines:
+        for key in data.keys():
+            prefix = key + ":"
+            if line.startswith(prefix):
+                data[key] = line[len(prefix):].strip()
+                break
+    return data
+
+
+def load_cards(pattern):
+    cards = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, newline="", encoding="utf-8") as f:
+            cards += [row for row in csv.DictReader(f) if all(row.get(key) for key in REQUIRED_KEYS)]
+    return cards
+
+
+def render(card, line=lambda key, value: f"{key}: {value}"):
+    return "\n".join(line(key, card[key]) for key in REQUIRED_KEYS)
+
+
+# Noise the parser must see through: (name, text) - the parsed card must equal the original
+NOISE = [
+    ("plain", lambda card, rng: render(card)),
+    ("bold_keys", lambda card, rng: render(card, lambda k, v: f"**{k}:** {v}")),
+    ("bold_keys_outside", lambda card, rng: render(card, lambda k, v: f"**{k}**: {v}")),
+    ("bold_values", lambda card, rng: render(card, lambda k, v: f"{k}: **{v}**")),
+    ("numbered", lambda card, rng: "\n".join(f"{i}. {k}: {card[k]}" for i, k in enumerate(REQUIRED_KEYS, 1))),
+    ("bullets", lambda card, rng: render(card, lambda k, v: f"- {k}: {v}")),
+    ("indented", lambda card, rng: render(card, lambda k, v: f"{' ' * rng.randint(1, 6)}{k}:   {v}  ")),
+    ("crlf", lambda card, rng: render(card).replace("\n", "\r\n")),
+    ("lowercase_lang", lambda card, rng: render(card).replace("(DE)", "(de)").replace("(EN)", "(en)")),
+    ("blank_lines", lambda card, rng: render(card).replace("\n", "\n\n")),
+    ("chatter", lambda card, rng: f"Sure! Here is the card:\n\n{render(card)}\n\nLet me know if you need more."),
+    ("second_card", lambda card, rng: render(card) + "\n\nGerman: noch ein Wort\nEnglish: another word"),
+]
+
+# Damage the parser must report: (name, text, expected problem fields)
+def _drop(card, rng):
+    key = rng.choice(REQUIRED_KEYS)
+    return "\n".join(f"{k}: {card[k]}" for k in REQUIRED_KEYS if k != key), {key}
+
+
+def _empty(card, rng):
+    key = rng.choice(REQUIRED_KEYS)
+    return render(dict(card, **{key: ""})), {key}
+
+
+def _truncate(card, rng):
+    text = render(card)
+    cut = text.rfind("\n", 0, rng.randint(1, len(text) - 1))
+    text = text[:cut] if cut > 0 else ""
+    return text, {key for key in REQUIRED_KEYS if f"{key}:" not in text}
+
+
+def _untranslated(card, rng):
+    return render(dict(card, **{"Example 1 (EN)": card["Example 1 (DE)"]})), {"Example 1 (EN)"}
+
+
+DAMAGE = [("drop_field", _drop), ("empty_field", _empty), ("truncated", _truncate), ("untranslated", _untranslated)]
+
+
+def garbage(card, rng):
+    """Random bytes spliced into a response: the parser must never raise on them"""
+    text = render(card)
+    pos = rng.randrange(len(text))
+    junk = "".join(rng.choice("*_:#-()\n\r\t 0123456789ExampleGerman") for _ in range(rng.randint(1, 40)))
+    return text[:pos] + junk + text[pos:]
+
+
+def build_corpus(cards, seed=0, garbage_per_card=5):
+    """List of (name, text, expected card or None, expected problem fields or None)"""
+    rng = random.Random(seed)
+    corpus = []
+    for i, card in enumerate(cards):
+        card = {key: card[key] for key in REQUIRED_KEYS}
+        for name, make in NOISE:
+            corpus.append((f"{i:03d}_{name}", make(card, rng), card, set()))
+        for name, make in DAMAGE:
+            text, problems = make(card, rng)
+            corpus.append((f"{i:03d}_{name}", text, None, problems))
+        for j in range(garbage_per_card):
+            corpus.append((f"{i:03d}_garbage{j}", garbage(card, rng), None, None))
+    return corpus
+
+
+def fuzz(corpus):
+    """Check the parser against the corpus; returns the list of failures"""
+    failures = []
+    for name, text, expected, problems in corpus:
+        try:
+            parsed, errors = parse_card(text)
+        except Exception as e:
+            failures.append(f"{name}: raised {e!r}")
+            continue
+        if set(parsed) != set(REQUIRED_KEYS):
+            failures.append(f"{name}: wrong keys {sorted(parsed)}")
+        if expected is not None and parsed != expected:
+            failures.append(f"{name}: parsed {parsed}")
+        if problems is not None and {error['field'] for error in errors} != problems:
+            failures.append(f"{name}: errors {errors}, expected problems with {sorted(problems)}")
+    return failures
+
+
+def microbench(texts, repeat=5):
+    """Best time per response in microseconds for each parser"""
+    results = {}
+    for name, parse in (("legacy", legacy_parse_response), ("parse_response", parse_response), ("parse_card", parse_card)):
+        number = max(1, 20000 // len(texts))
+        best = min(timeit.repeat(lambda: [parse(text) for text in texts], number=number, repeat=repeat))
+        results[name] = best / (number * len(texts)) * 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz check and microbenchmark of the card parser")
+    parser.add_argument("--cards", default=os.path.join(REPO_ROOT, "anki_cards_*.csv"), help="Glob of CSV files with real cards")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the mutations")
+    parser.add_argument("--write-corpus", metavar="DIR", help="Write every corpus entry to DIR as a text file")
+    args = parser.parse_args()
+
+    cards = load_cards(args.cards)
+    if not cards:
+        sys.exit(f"No complete cards found in {args.cards}")
+    corpus = build_corpus(cards, args.seed)
+
+    if args.write_corpus:
+        os.makedirs(args.write_corpus, exist_ok=True)
+        for name, text, _, _ in corpus:
+            with open(os.path.join(args.write_corpus, f"{name}.txt"), "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+        print(f"Wrote {len(corpus)} responses to '{args.write_corpus}'")
+
+    failures = fuzz(corpus)
+    print(f"Fuzz: {len(corpus)} responses from {len(cards)} cards, {len(failures)} failures")
+    for failure in failures[:20]:
+        print(f"  {failure}")
+
+    clean = [text for name, text, _, _ in corpus if name.endswith("_plain")]
+    for label, texts in (("clean", clean), ("whole corpus", [text for _, text, _, _ in corpus])):
+        timings = microbench(texts)
+        print(f"{label:<13} " + "  ".join(f"{name} {us:6.2f} us" for name, us in timings.items()))
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Time-to-first-token with and without the prefix prompt layout
+
+Sends the same words once per prompt layout as streamed requests and reports the time
+until the first token arrived. Against a server with prompt caching (llama.cpp, LM Studio)
+the prefix layout only has to process the short per-word suffix of each prompt.
+
+    python -m bench.prompt_cache --llm-endpoint http://localhost:1234/v1 --model <model>
+
+Without --llm-endpoint a fake server is started that simulates a single-slot prompt cache.
+"""
+import argparse
+import os
+import sys
+import time
+
+from bench.fake_servers import FakePromptCache, fake_llm_server
+from utils.llm import chat_completion, close_llm, configure_llm
+from utils.metrics import Histogram
+from utils.utils import PROMPT_LAYOUTS, SAMPLING_PARAMS, CardStreamParser, build_messages, read_prompt_template
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def shared_prefix(template, words, layout):
+    """Number of characters the rendered prompts of two different words have in common"""
+    rendered = [
+        "".join(f"<|{m['role']}|>{m['content']}" for m in build_messages(template, word, layout))
+        for word in words[:2]
+    ]
+    return len(os.path.commonprefix(rendered)), len(rendered[0])
+
+
+def measure(template, words, layout, model):
+    histogram = Histogram()
+    for word in words:
+        parser = CardStreamParser()
+        start = time.perf_counter()
+        chat_completion(model, build_messages(template, word, layout), SAMPLING_PARAMS, stream_parser=parser)
+        if parser.first_chunk_at is not None:
+            histogram.observe(parser.first_chunk_at - start)
+    return histogram.summary()
+
+
+def run(args, base_url):
+    template = read_prompt_template(args.template)
+    with open(args.vocab, encoding="utf-8") as f:
+        words = [line.strip() for line in f if line.strip()][:args.count]
+    if len(words) < 2:
+        sys.exit("Need at least two words")
+
+    configure_llm(base_url=base_url, stream=True)
+    try:
+        for layout in PROMPT_LAYOUTS:
+            # The first request fills the server's cache with this layout's prefix
+            measure(template, words[:1], layout, args.model)
+            summary = measure(template, words[1:], layout, args.model)
+            shared, total = shared_prefix(template, words, layout)
+            mean = summary["total"] / summary["count"] if summary["count"] else 0.0
+            print(
+                f"{layout:<9} TTFT mean {mean * 1000:7.1f} ms  p50 {summary['p50'] * 1000:7.1f} ms  "
+                f"p95 {summary['p95'] * 1000:7.1f} ms  ({summary['count']} requests, "
+                f"{shared}/{total} prompt chars shared between words)"
+            )
+    finally:
+        close_llm()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure time-to-first-token for each prompt layout")
+    parser.add_argument("--llm-endpoint", help="OpenAI-compatible server to measure (default: a local fake server)")
+    parser.add_argument("--model", default="meta-llama-3.1-8b-instruct", help="Model identifier")
+    parser.add_argument("--template", default=os.path.join(REPO_ROOT, "prompt.template"), help="Prompt template")
+    parser.add_argument("--vocab", default=os.path.join(REPO_ROOT, "words.txt"), help="Words to send")
+    parser.add_argument("--count", type=int, default=20, help="Number of words per layout")
+    parser.add_argument("--prefill-per-char", type=float, default=0.0002, help="Prompt processing time per uncached character of the fake server")
+    args = parser.parse_args()
+
+    if args.llm_endpoint:
+        run(args, args.llm_endpoint)
+        return
+    with fake_llm_server(prompt_cache=FakePromptCache(args.prefill_per_char)) as llm:
+        run(args, f"http://127.0.0.1:{llm.port}/v1")
+
+
+if __name__ == "__main__":
+    main()
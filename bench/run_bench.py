@@ -0,0 +1,141 @@
+"""
+Offline throughput benchmark for main.py
+
+Starts a fake OpenAI-compatible server and a fake AnkiConnect on localhost, stubs TTS
+with the fake engine, and runs the real main.py over synthetic word lists. Reports
+cards/sec, per-stage p50/p95 latency and the peak RSS of each run.
+
+    python -m bench.run_bench --sizes 10 1000 10000 --workers 8
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.fake_servers import FaultInjector, fake_anki_server, fake_llm_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_word_list(path, size):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(size):
+            f.write(f"Wort{i:06d}\n")
+
+
+def run_main(workdir, main_args):
+    """Run main.py in workdir, returning (exit code, wall time, peak RSS in MB)"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_ROOT, "main.py"), *main_args],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    # wait4 reports the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    stderr = process.stderr.read().decode("utf-8", "replace")
+    process.stderr.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode not in (0, 1):
+        print(stderr[-2000:], file=sys.stderr)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return process.returncode, elapsed, peak_rss
+
+
+def bench_size(size, args):
+    with tempfile.TemporaryDirectory(prefix="cardgen-bench-") as workdir:
+        vocab = os.path.join(workdir, "words.txt")
+        report_path = os.path.join(workdir, "report.json")
+        media = os.path.join(workdir, "media")
+        os.makedirs(media)
+        write_word_list(vocab, size)
+        for template in ("prompt.template", "prompt_batch.template"):
+            with open(os.path.join(REPO_ROOT, template), "rb") as src, open(os.path.join(workdir, template), "wb") as dest:
+                dest.write(src.read())
+
+        llm_faults = FaultInjector(args.llm_latency, args.llm_jitter, args.error_rate, seed=size, capacity=args.llm_capacity)
+        anki_faults = FaultInjector(args.anki_latency, 0.0, args.error_rate, seed=size + 1)
+        with fake_llm_server(llm_faults) as llm, fake_anki_server(anki_faults) as anki:
+            main_args = [
+                "--vocab", vocab,
+                "--deck", "bench",
+                "--llm-endpoint", f"http://127.0.0.1:{llm.port}/v1",
+                "--anki-url", f"http://127.0.0.1:{anki.port}",
+                "--anki-media-folder", media,
+                "--tts-engine", "fake",
+                "--no-cache",
+                "--retry-backoff", "0.05",
+                "--workers", str(args.workers),
+                "--batch-size", str(args.batch_size),
+                "--report", report_path,
+                *args.main_args,
+            ]
+            code, wall_time, peak_rss = run_main(workdir, main_args)
+
+        report = {}
+        if os.path.exists(report_path):
+            with open(report_path, encoding="utf-8") as f:
+                report = json.load(f)
+
+    return {
+        "size": size,
+        "exit_code": code,
+        "wall_time": wall_time,
+        "peak_rss_mb": peak_rss,
+        "cards": report.get("cards", 0),
+        "failed": report.get("failed", 0),
+        "cards_per_sec": report.get("cards_per_sec", 0.0),
+        "stages": report.get("stages", {}),
+        "llm_requests": llm_faults.requests,
+        "llm_peak_in_flight": llm_faults.peak_in_flight,
+        "concurrency": {name: value for name, value in report.get("gauges", {}).items() if name.startswith("concurrency.")},
+        "anki_requests": anki_faults.requests,
+    }
+
+
+def print_result(result):
+    print(
+        f"{result['size']:>7} words: {result['cards']} cards, {result['failed']} failed, "
+        f"{result['cards_per_sec']:.1f} cards/s, wall {result['wall_time']:.1f}s, peak RSS {result['peak_rss_mb']:.0f} MB, "
+        f"{result['llm_requests']} LLM / {result['anki_requests']} AnkiConnect requests, "
+        f"at most {result['llm_peak_in_flight']} LLM requests in flight"
+    )
+    if result["concurrency"]:
+        print(f"{'':>15}adaptive limits: " + ", ".join(f"{name[len('concurrency.'):]} {value}" for name, value in result["concurrency"].items()))
+    for name, stage in result["stages"].items():
+        print(f"{'':>15}{name:<5} p50 {stage['p50'] * 1000:8.1f} ms  p95 {stage['p95'] * 1000:8.1f} ms  ({stage['count']} items)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py against local fake servers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="Word list sizes to run")
+    parser.add_argument("--workers", type=int, default=8, help="--workers passed to main.py")
+    parser.add_argument("--batch-size", type=int, default=1, help="--batch-size passed to main.py")
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="Mean latency of the fake LLM in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.005, help="Random latency added to or removed from each fake LLM request")
+    parser.add_argument("--llm-capacity", type=int, help="Concurrent requests the fake LLM serves at full speed; more slow every request down")
+    parser.add_argument("--anki-latency", type=float, default=0.002, help="Latency of the fake AnkiConnect in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests the fake servers fail with HTTP 500")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("main_args", nargs="*", help="Extra arguments for main.py (put them after --)")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        result = bench_size(size, args)
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,135 +1,775 @@
-from datetime import datetime
-from tqdm import tqdm
 import argparse
+import hashlib
+import json
 import os
+import sys
+import threading
+import time
 
-from utils.utils import get_anki_media_folder, read_words, read_prompt_template, response_lmstudio, parse_response, write_csv
-from utils.anki import add_note_to_anki, create_model_if_missing, ensure_deck_exists
-from utils.tts import generate_audio
+from utils.utils import (
+    get_anki_media_folder, read_prompt_template, response_lmstudio, response_lmstudio_batch,
+    parse_card, describe_card_errors, parse_responses, is_complete_card, CardCSVWriter, normalize_word, token_usage,
+    SYSTEM_PROMPT, SAMPLING_PARAMS, BATCH_SAMPLING_PARAMS, PROMPT_LAYOUTS,
+)
+from utils.cache import ResponseCache, generation_tag, response_cache_key
+from utils.anki import (
+    ANKI_CONNECT_URL, AnkiConnectClient, build_note, delete_notes, fetch_existing_words, fetch_notes, prepare_anki,
+    update_notes,
+)
+from utils.tts import TTSService, TTS_ENGINES, get_tts_backend
+from utils.llm import LLM_BASE_URL, close_llm, configure_llm, llm_endpoint_report, llm_endpoint_summary
+from utils.apkg import ApkgWriter
+from utils.media import MEDIA_STRATEGIES, MediaTransfer
+from utils.vocab import DEDUP_POLICIES, HEADER_MODES, VocabReader, unique_words, word_key
+from utils.journal import RunJournal, new_run_id
+from utils.retry import GenerationError, RetryPolicy
+from utils.metrics import ThreadProfiler, metrics
+from utils.pipeline import Stage, StageError, chunked, run_pipeline
 
-def get_words_from_args(words_args, vocab_file):
-    """Get words from either command line arguments or file"""
+def get_words_from_args(words_args, vocab_file, column=None, delimiter=None, dedup="articles", header="auto"):
+    """
+    Get words from either command line arguments or a file
+
+    Words from a file (or stdin, with "-") are read lazily by a VocabReader, so large
+    lists are never loaded into memory at once. Duplicates are dropped in both cases.
+    """
     if words_args:
-        print(f"Processing {len(words_args)} words from arguments: {', '.join(words_args)}")
-        return words_args
-    elif vocab_file and os.path.exists(vocab_file):
-        words = read_words(vocab_file)
-        print(f"Processing {len(words)} words from file: {vocab_file}")
+        words = unique_words(words_args, dedup)
+        print(f"Processing {len(words)} words from arguments: {', '.join(words)}")
         return words
+    elif vocab_file == "-" or (vocab_file and os.path.exists(vocab_file)):
+        print(f"Reading words from {'stdin' if vocab_file == '-' else f'file: {vocab_file}'}")
+        return VocabReader(vocab_file, column=column, delimiter=delimiter, dedup=dedup, header=header)
     else:
         raise ValueError("Either provide --words or use --vocab")
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate Anki cards from words")
+def generate_card(word, prompt_template, model, cache=None, refresh=False, retry=None, layout="template"):
+    """
+    Ask the LLM for a card until it returns all required fields, reusing cached responses
+
+    Failed requests are retried with exponential backoff. Invalid output is retried at a
+    lower temperature first, then by showing the model its previous answer and what was
+    wrong with it. Raises GenerationError once retry.max_attempts is used up.
+    """
+    retry = retry or RetryPolicy()
+    cache_key = None
+    if cache is not None:
+        cache_key = response_cache_key(word, prompt_template, SYSTEM_PROMPT, model, SAMPLING_PARAMS, layout)
+        cached = None if refresh else cache.get(cache_key)
+        if cached and is_complete_card(cached[1]):
+            return cached[1]
+
+    temperature = None
+    feedback = None
+    last_error = None
+    for attempt in range(1, retry.max_attempts + 1):
+        try:
+            response_text = response_lmstudio(word, prompt_template, model=model, temperature=temperature, feedback=feedback, layout=layout)
+        except Exception as e:
+            last_error = e
+            metrics.incr("llm.request_failures")
+            if attempt < retry.max_attempts:
+                print(f"Request for word '{word}' failed ({e}), retrying...")
+                metrics.incr("llm.retries")
+                with metrics.span("llm.backoff"):
+                    retry.sleep(attempt)
+            continue
+
+        parsed, errors = parse_card(response_text, word=word)
+        if not errors:
+            token_usage.add_cards(1)
+            if cache is not None:
+                cache.put(cache_key, word, response_text, parsed)
+            return parsed
+
+        # The re-prompt names exactly which fields were wrong and how
+        last_error = describe_card_errors(errors)
+        metrics.incr("llm.parse_failures")
+        if attempt < retry.max_attempts:
+            metrics.incr("llm.retries")
+            print(f"Invalid output format for word '{word}' ({last_error}), retrying...")
+        # Escalate: first retry more deterministically, then also show the model its mistake
+        if temperature is not None:
+            feedback = (response_text, last_error)
+        temperature = retry.retry_temperature
+
+    metrics.incr("llm.gave_up")
+    raise GenerationError(word, retry.max_attempts, last_error)
+
+def generate_cards(words, prompt_template, batch_template, model, cache=None, refresh=False, retry=None, layout="template"):
+    """
+    Generate cards for several words with a single LLM request
+
+    Words whose card is missing, incomplete or about another word fall back to
+    single-word requests. Returns one card dict per word, in order: {"word", "parsed"}
+    on success, {"word", "error"} if the word could not be generated.
+    """
+    cards = {}
+    batch_keys = {}
+    if cache is not None:
+        for word in words:
+            batch_keys[word] = response_cache_key(word, batch_template, SYSTEM_PROMPT, model, BATCH_SAMPLING_PARAMS, layout)
+            if refresh:
+                continue
+            # A card generated alone is as good as one generated in a batch
+            single_key = response_cache_key(word, prompt_template, SYSTEM_PROMPT, model, SAMPLING_PARAMS, layout)
+            cached = cache.get(batch_keys[word], single_key)
+            if cached and is_complete_card(cached[1]):
+                cards[word] = cached[1]
+
+    todo = [word for word in words if word not in cards]
+    if len(todo) > 1:
+        try:
+            with metrics.span("llm.batch", words=len(todo)):
+                response_text = response_lmstudio_batch(todo, batch_template, model=model, layout=layout)
+            for word, (parsed, errors) in zip(todo, parse_responses(response_text, todo)):
+                if not errors:
+                    token_usage.add_cards(1)
+                    cards[word] = parsed
+                    if cache is not None:
+                        cache.put(batch_keys[word], word, response_text, parsed)
+        except Exception as e:
+            print(f"Batched request failed ({e}), falling back to single words...")
+        metrics.incr("llm.batch_fallbacks", sum(1 for word in todo if word not in cards))
+
+    results = []
+    for word in words:
+        if word not in cards:
+            try:
+                # The cache was already checked above, so skip the lookup (the result is still stored)
+                cards[word] = generate_card(word, prompt_template, model, cache=cache, refresh=refresh or cache is not None, retry=retry, layout=layout)
+            except Exception as e:
+                results.append({"word": word, "error": e})
+                continue
+        results.append({"word": word, "parsed": cards[word]})
+    return results
+
+def generate_card_audio(parsed_cards, tts, unique_names=False):
+    """
+    Generate the word and example audio files for several cards in parallel
+
+    With unique_names, file names end in a hash of the spoken text, so a regenerated
+    sentence never reuses the name of an older clip that is already in Anki's media.
+    """
+    items = []
+    for parsed in parsed_cards:
+        # Clean filename - remove special characters
+        clean_word = parsed['German'].replace(' ', '_').replace('(', '').replace(')', '').replace('/', '_')
+        word_for_pronunciation = parsed['German'].split('(')[0].strip() # Clean word for pronunciation - remove parenthetical parts
+        clips = [
+            (word_for_pronunciation, clean_word),
+            (parsed["Example 1 (DE)"], f"{clean_word}_ex1"),
+            (parsed["Example 2 (DE)"], f"{clean_word}_ex2"),
+        ]
+        if unique_names:
+            clips = [(text, f"{name}_{hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]}") for text, name in clips]
+        items += clips
+
+    paths = tts.generate_many(items)
+    return [
+        {
+            "Audio_Word": paths[i],
+            "Audio_Example_1": paths[i + 1],
+            "Audio_Example_2": paths[i + 2],
+        }
+        for i in range(0, len(paths), 3)
+    ]
+
+def build_card_note(parsed, audio_files, deck, media, tags=None):
+    """Build the Anki note for a generated card, tagged "auto" plus `tags`"""
+    # Fields dictionary must include all fields used in your Anki model
+    fields = {
+        "Word": parsed["German"],
+        "Meaning": parsed["English"],
+        "Example_1": parsed.get("Example 1 (DE)", ""),
+        "Translation_1": parsed.get("Example 1 (EN)", ""),
+        "Example_2": parsed.get("Example 2 (DE)", ""),
+        "Translation_2": parsed.get("Example 2 (EN)", ""),
+        "Audio_Word": "", # These will be filled by Anki
+        "Audio_Example_1": "",
+        "Audio_Example_2": ""
+    }
+
+    return build_note(
+        deck_name=deck,
+        model_name="AnkiCardGen",
+        fields=fields,
+        audio_files=audio_files,
+        tags=["auto", *(tags or [])],
+        media=media
+    )
+
+def report_push_results(results, journal=None):
+    """Print the outcome of a flushed batch of notes and journal the notes that are in Anki now"""
+    for word, res in results:
+        if res.get("error"):
+            print(f"Failed to add note for '{word}': {res['error']}")
+            continue
+        if res.get("result") == "skipped":
+            print(f"Note for '{word}' already exists, skipping...")
+        else:
+            print(f"Successfully added note for: {word}")
+        if journal is not None:
+            journal.record(word, "pushed", res.get("result"))
+
+def find_media_folder(args, anki=None):
+    """Anki media folder from the arguments, from prepare_anki or auto-detected (None if it can't be found)"""
+    if args.anki_media_folder:
+        anki_media_folder = args.anki_media_folder
+    elif anki is not None:
+        anki_media_folder = anki["media_folder"]
+    else:
+        anki_media_folder = get_anki_media_folder()
+
+    if not anki_media_folder or not os.path.exists(anki_media_folder):
+        print("Warning: Could not find Anki media folder. Audio files will be uploaded through AnkiConnect instead.")
+        print("Please specify --anki-media-folder manually or ensure Anki is installed.")
+        return None
+    return anki_media_folder
+
+def print_concurrency_limits():
+    """Print the limits the adaptive limiters ended up at (also in the report's gauges)"""
+    limits = {name[len("concurrency."):-len(".limit")]: value for name, value in metrics.gauges.items() if name.startswith("concurrency.") and name.endswith(".limit")}
+    print("Adaptive concurrency: " + ", ".join(
+        f"{name} {limit} (peak {metrics.gauges[f'concurrency.{name}.peak']})" for name, limit in sorted(limits.items())
+    ))
+
+def anki_state_file(args):
+    """File caching the deck, note type and media folder found in earlier runs"""
+    return None if args.no_anki_state else os.path.join(args.cache_dir, "anki_state.json")
+
+def make_tts_service(args, media=None):
+    """TTSService for the run; raises ValueError for an unusable --tts-engine"""
+    backend = get_tts_backend(args.tts_engine, piper_model=args.piper_model)
+    audio_folder, cache_folder = args.audio_folder, None
+    if media is not None and media.strategy == "direct":
+        # Link clips straight into collection.media, keeping the TTS cache out of it
+        audio_folder, cache_folder = media.media_folder, os.path.join(args.audio_folder, ".tts_cache")
+    return TTSService(audio_folder, max_workers=args.tts_workers or args.workers, rate_limit=args.tts_rate_limit, cache_folder=cache_folder, backend=backend, adaptive=args.adaptive_concurrency)
+
+def connect_anki(args):
+    """AnkiConnect client and what prepare_anki found (None if AnkiConnect is unreachable)"""
+    anki_client = AnkiConnectClient(url=args.anki_url, batch_size=args.anki_batch_size, adaptive=args.adaptive_concurrency)
+    find_media = not args.no_audio and bool(args.audio_folder) and not args.anki_media_folder
+    anki = prepare_anki(anki_client, args.deck, "AnkiCardGen", state_file=anki_state_file(args), find_media=find_media)
+    return anki_client, anki
+
+def make_media_transfer(args, anki_client, anki):
+    """MediaTransfer moving the clips into Anki (None without audio or without a reachable AnkiConnect)"""
+    if anki is None or args.no_audio or not args.audio_folder:
+        return None
+    os.makedirs(args.audio_folder, exist_ok=True)
+    media = MediaTransfer(find_media_folder(args, anki), args.media_transfer, client=anki_client, source_folder=args.audio_folder)
+    print(f"Transferring audio to Anki with strategy: {media.strategy}")
+    return media
+
+def start_llm(args):
+    """Configure the LLM endpoints; returns the retry policy and the response cache (None with --no-cache)"""
+    configure_llm(base_url=args.llm_endpoint, max_in_flight=args.workers, stream=args.stream, timeout=args.llm_timeout, adaptive=args.adaptive_concurrency)
+    retry = RetryPolicy(max_attempts=args.max_attempts, base_delay=args.retry_backoff)
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, max_size_mb=args.cache_max_size, max_age_days=args.cache_max_age)
+    return retry, cache
+
+def note_match_key(dedup):
+    """Key matching deck notes to input words: the same one used to drop duplicates from the input"""
+    return (lambda word: word_key(word, dedup)) if dedup in ("case", "articles") else normalize_word
+
+def finished_cards(pipeline, failed_words, progress):
+    """Cards coming out of the pipeline in input order; words that failed are printed and added to failed_words"""
+    for batch, cards in pipeline:
+        if isinstance(cards, StageError):
+            cards = [{"word": word, "error": cards} for word in batch]
+        for card in cards:
+            if "error" in card:
+                print(f"Failed to generate card for '{card['word']}' ({card['error']})")
+                failed_words.append(card["word"])
+            else:
+                yield card
+        progress.update(len(batch))
+
+def close_backends(args, tts, cache):
+    """Close the LLM connections, TTS service and response cache, printing their summaries"""
+    close_llm()
+    print(token_usage.summary())
+    if len(args.llm_endpoint) > 1:
+        print("LLM endpoints:")
+        print(llm_endpoint_summary())
+    if tts is not None:
+        tts.close()
+        print(tts.summary())
+    if args.adaptive_concurrency:
+        print_concurrency_limits()
+    if cache is not None:
+        print(f"LLM response cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
+
+def build_parser(command="generate"):
+    """Command line options of the default command or of `sync`"""
+    if command == "sync":
+        parser = argparse.ArgumentParser(
+            prog="main.py sync",
+            description="Bring an Anki deck in line with a vocabulary: add missing notes and regenerate notes made with another template or model",
+        )
+    else:
+        parser = argparse.ArgumentParser(description="Generate Anki cards from words", epilog="Run 'main.py sync --help' to update an existing deck instead.")
     parser.add_argument("--deck", "-d", default="test", help="Name of your deck on Anki")
 
-    # Word input options - mutually exclusive group
-    word_group = parser.add_mutually_exclusive_group(required=True)
+    # Word input options - mutually exclusive group (optional when resuming a run)
+    word_group = parser.add_mutually_exclusive_group()
     word_group.add_argument("--words", "-w", nargs="+", help="Words to generate cards for")
-    word_group.add_argument("--vocab", "-v", help="Path to vocabulary file")
+    word_group.add_argument("--vocab", "-v", help="Path to vocabulary file (one word per line, or .csv/.tsv), or - to read from stdin")
+    parser.add_argument("--vocab-column", help="Column holding the words in a CSV/TSV vocabulary file: header name or 1-based index (default: first column)")
+    parser.add_argument("--vocab-delimiter", help="Field delimiter of the vocabulary file, e.g. ',' or 'tab' (default: guessed from .csv/.tsv extension, otherwise one word per line)")
+    parser.add_argument("--vocab-header", choices=HEADER_MODES, default="auto", help="Whether the first row of a CSV/TSV vocabulary file is a header: yes, no, or auto (yes when --vocab-column is a name, otherwise guessed from the first rows)")
+    parser.add_argument("--dedup", choices=DEDUP_POLICIES, default="articles", help="Which input words count as duplicates: exact, case (ignoring case and whitespace), articles (also ignoring der/die/das/...) or none")
 
     parser.add_argument("--template", default="prompt.template", help="LLM prompt for generating cards")
-    parser.add_argument("--no-anki", action="store_true", help="Don't push the generated cards to Anki (default: cards are pushed)")
+    parser.add_argument("--batch-template", default="prompt_batch.template", help="LLM prompt for generating several cards in one request (used with --batch-size)")
+    parser.add_argument("--prompt-layout", choices=PROMPT_LAYOUTS, default="prefix", help="prefix: keep every static part of the prompt in one identical prefix so the LLM server can reuse its prompt cache across words; template: fill the word into the template as written")
+    parser.add_argument("--batch-size", type=int, default=1, help="Number of words per LLM request")
+    parser.add_argument("--llm-endpoint", nargs="+", default=[LLM_BASE_URL], metavar="URL[=WEIGHT]", help="Base URL of the OpenAI-compatible LLM server. Give several to balance requests between them, each optionally with a concurrency weight (default 1)")
+    parser.add_argument("--llm-timeout", type=float, help="Seconds before an LLM request times out (and fails over to another endpoint)")
+    parser.add_argument("--stream", action="store_true", help="Stream LLM responses and cut them off as soon as every card field has arrived")
+    parser.add_argument("--max-attempts", type=int, default=4, help="Maximum number of LLM attempts per word before giving up on it")
+    parser.add_argument("--retry-backoff", type=float, default=1.0, help="Initial delay in seconds before retrying a failed LLM request (doubles every retry)")
+    parser.add_argument("--failed-words", default="failed_words.txt", help="File listing the words that could not be generated")
+    if command != "sync":
+        parser.add_argument("--no-anki", action="store_true", help="Don't push the generated cards to Anki (default: cards are pushed)")
+        parser.add_argument("--output", choices=["anki", "apkg"], default="anki", help="anki: push the cards through AnkiConnect; apkg: write them with their audio into an .apkg package to import into Anki, without Anki running")
+        parser.add_argument("--apkg-file", help="Path of the .apkg package written with --output apkg (default: named like the CSV file)")
     parser.add_argument("--no-audio", action="store_true", help="Don't generate TTS files (default: audio is generated)")
     parser.add_argument("--audio-folder", default="audio", help="Folder path for audio files")
     parser.add_argument("--anki-media-folder", help="Path to Anki media folder (auto-detected if not provided)")
+    parser.add_argument("--media-transfer", choices=MEDIA_STRATEGIES, default="auto", help="How audio files get into Anki: hardlink, reflink, copy, direct (synthesize into the media folder), store (upload with storeMediaFile) or auto (fastest that works)")
     parser.add_argument("--model", default="meta-llama-3.1-8b-instruct", help="Path or identifier for LMStudio model")
-    args = parser.parse_args()
+    parser.add_argument("--workers", type=int, default=1, help="Number of concurrent LLM requests (1 = process words one by one)")
+    parser.add_argument("--tts-workers", type=int, help="Number of concurrent TTS syntheses (default: same as --workers)")
+    parser.add_argument("--tts-rate-limit", type=float, help="Maximum number of TTS clips synthesized per second")
+    parser.add_argument("--tts-engine", choices=TTS_ENGINES, default="gtts", help="TTS engine: gtts (online), piper/espeak (local) or fake (silent clips, for testing)")
+    parser.add_argument("--piper-model", help="Path to the piper voice model (.onnx) used by --tts-engine piper")
+    parser.add_argument("--anki-workers", type=int, default=1, help="Number of concurrent AnkiConnect pushes")
+    parser.add_argument("--adaptive-concurrency", action="store_true", help="Adapt the number of concurrent LLM, TTS and AnkiConnect calls to each backend's latency, backing off on slowdowns, timeouts, 429 and 5xx. --workers and --tts-workers become upper bounds")
+    parser.add_argument("--anki-url", default=ANKI_CONNECT_URL, help="AnkiConnect URL")
+    parser.add_argument("--anki-batch-size", type=int, default=50, help="Number of notes pushed to AnkiConnect per request")
+    parser.add_argument("--cache-dir", default=".cardgen_cache", help="Folder for the on-disk LLM response cache")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the LLM response cache")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached LLM responses and overwrite them with fresh ones")
+    parser.add_argument("--cache-max-size", type=float, default=500, help="Maximum LLM response cache size in MB (least recently used entries are evicted)")
+    parser.add_argument("--no-anki-state", action="store_true", help="Don't use the cached deck, note type and media folder of earlier runs (<cache-dir>/anki_state.json)")
+    parser.add_argument("--cache-max-age", type=float, help="Evict cached LLM responses older than this many days")
+    parser.add_argument("--report", help="Write a JSON summary of the run (throughput, per-stage latency, counters, histograms) to this file")
+    parser.add_argument("--trace", help="Write a Chrome trace of every stage, request and retry to this file (open in chrome://tracing or ui.perfetto.dev)")
+    parser.add_argument("--profile", help="Run under cProfile (all threads), save the stats to this file and print the top functions")
+    if command != "sync":
+        parser.add_argument("--runs-dir", default=".cardgen_runs", help="Folder for the progress journals of runs")
+        parser.add_argument("--resume", metavar="RUN_ID", help="Resume an interrupted run, skipping the work it already completed")
+    if command == "sync":
+        parser.add_argument("--delete", action="store_true", help="Also delete notes whose word is no longer in the vocabulary")
+        parser.add_argument("--dry-run", action="store_true", help="Only print what would be added, updated and deleted")
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = "generate"
+    if argv and argv[0] == "sync":
+        command, argv = "sync", argv[1:]
+    args = build_parser(command).parse_args(argv)
+    run_command = sync if command == "sync" else run
+
+    if args.trace:
+        metrics.enable_tracing()
+    if not args.profile:
+        return run_command(args)
+
+    profiler = ThreadProfiler()
+    profiler.start()
+    try:
+        return run_command(args)
+    finally:
+        stats = profiler.stop()
+        stats.dump_stats(args.profile)
+        print(f"Profile written to '{args.profile}' (inspect with: python -m pstats {args.profile})")
+        stats.sort_stats("cumulative").print_stats(25)
+
+def write_outputs(args, stages, cards, failed_words, elapsed, retry_command="main.py", **extra):
+    """Write the --report and --trace files and the list of failed words, and print the outcome"""
+    if args.report:
+        report = {
+            **extra,
+            "cards": cards,
+            "failed": len(failed_words),
+            "elapsed": elapsed,
+            "cards_per_sec": cards / elapsed if elapsed else 0.0,
+            "stages": {stage.name: stage.latency_summary() for stage in stages},
+            "llm": {
+                "requests": token_usage.requests,
+                "prompt_tokens": token_usage.prompt_tokens,
+                "completion_tokens": token_usage.completion_tokens,
+                "endpoints": llm_endpoint_report(),
+            },
+            **metrics.report(),
+        }
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Run report written to '{args.report}'")
+    if args.trace:
+        metrics.write_chrome_trace(args.trace)
+        print(f"Trace written to '{args.trace}'")
+
+    print(f"Finished: {cards} cards generated, {len(failed_words)} words failed")
+    if failed_words:
+        with open(args.failed_words, "w", encoding="utf-8") as f:
+            f.writelines(f"{word}\n" for word in failed_words)
+        print(f"Failed words were written to '{args.failed_words}', retry them with: {retry_command} --vocab {args.failed_words}")
+
+def run(args):
+    """Generate the cards for parsed command line arguments"""
+    if args.resume:
+        if not os.path.exists(os.path.join(args.runs_dir, f"{args.resume}.jsonl")):
+            print(f"Error: No run '{args.resume}' found in '{args.runs_dir}'")
+            return 1
+        journal = RunJournal(args.runs_dir, args.resume, resume=True)
+        # The words of the interrupted run are used unless new ones are given
+        if not args.words and not args.vocab:
+            args.words = journal.meta.get("words")
+            args.vocab = journal.meta.get("vocab")
+            args.vocab_column = args.vocab_column or journal.meta.get("vocab_column")
+            args.vocab_delimiter = args.vocab_delimiter or journal.meta.get("vocab_delimiter")
+            args.vocab_header = journal.meta.get("vocab_header", args.vocab_header)
+        output_filename = journal.meta["csv"]
+        print(f"Resuming run {journal.run_id} ({len(journal.states)} words already started)")
+    else:
+        run_id = new_run_id()
+        output_filename = f"anki_cards_{run_id}.csv"
+        journal = RunJournal(args.runs_dir, run_id, meta={
+            "words": args.words,
+            "vocab": os.path.abspath(args.vocab) if args.vocab and args.vocab != "-" else args.vocab,
+            "vocab_column": args.vocab_column,
+            "vocab_delimiter": args.vocab_delimiter,
+            "vocab_header": args.vocab_header,
+            "deck": args.deck,
+            "csv": output_filename,
+        })
+        print(f"Run id: {run_id} (resume with --resume {run_id} if interrupted)")
 
     # Get words from arguments or file
     try:
-        words = get_words_from_args(args.words, args.vocab)
+        words = get_words_from_args(args.words, args.vocab, args.vocab_column, args.vocab_delimiter, args.dedup, args.vocab_header)
     except ValueError as e:
         print(f"Error: {e}")
         return 1
+    words_source = words
 
-    push_to_anki = not args.no_anki
+    write_apkg = args.output == "apkg"
+    push_to_anki = not args.no_anki and not write_apkg
     generate_tts = not args.no_audio
     prompt_template = read_prompt_template(args.template)
+    batch_template = read_prompt_template(args.batch_template) if args.batch_size > 1 else None
+    retry, cache = start_llm(args)
+    # Lets a later sync tell which notes were made with the current template and model
+    tag = generation_tag(batch_template or prompt_template, SYSTEM_PROMPT, args.model, args.prompt_layout)
 
-    results = []
+    # Words are filtered lazily as the pipeline pulls them; the counts are reported at the end
+    skipped = {"finished": 0, "existing": 0}
+    progress = None
 
-    # Get Anki media folder
-    anki_media_folder = None
-    if push_to_anki and generate_tts:
-        if args.anki_media_folder:
-            anki_media_folder = args.anki_media_folder
-        else:
-            anki_media_folder = get_anki_media_folder()
-            
-        if not anki_media_folder or not os.path.exists(anki_media_folder):
-            print("Warning: Could not find Anki media folder. Audio files will not be copied to Anki.")
-            print("Please specify --anki-media-folder manually or ensure Anki is installed.")
-            anki_media_folder = None
+    def skip(reason):
+        skipped[reason] += 1
+        # The filters only run once the pipeline pulls words, so the progress bar exists by then;
+        # skipped words are part of its total, so they advance it too
+        progress.update(1)
 
-    if push_to_anki:
-        ensure_deck_exists(args.deck)
-        create_model_if_missing("AnkiCardGen")
-
-    for word in tqdm(words, desc="Generating cards"):
-        while True:
-            response_text = response_lmstudio(word, prompt_template, model=args.model)
-            parsed = parse_response(response_text)
-            
-            # Check that required fields are non-empty
-            #required_keys = ["Word", "Meaning", "Example_1", "Translation_1", "Example_2", "Translation_2"]
-            required_keys = ["German", "English", "Example 1 (DE)", "Example 1 (EN)", "Example 2 (DE)", "Example 2 (EN)"]
-            if all(parsed.get(k) for k in required_keys):
-                break
-            print(f"Invalid output format for word '{word}', retrying...")
-
-        audio_files = None
-        if generate_tts and args.audio_folder:
-            audio_files = {}
-
-            # Clean filename - remove special characters    
-            clean_word = parsed['German'].replace(' ', '_').replace('(', '').replace(')', '').replace('/', '_')
-            # Generate audio for the main word
-            word_for_pronunciation = parsed['German'].split('(')[0].strip() # Clean word for pronunciation - remove parenthetical parts
-            word_audio_path = generate_audio(word_for_pronunciation, clean_word, args.audio_folder)
-            audio_files["Audio_Word"] = word_audio_path
-
-            # Generate audio for the examples
-            for idx in [1, 2]:
-                key = f"Example {idx} (DE)"
-                filename_base = f"{clean_word}_ex{idx}"
-                audio_path = generate_audio(parsed[key], filename_base, args.audio_folder)
-                audio_files[f"Audio_Example_{idx}"] = audio_path
-
-        if push_to_anki:
-            # Fields dictionary must include all fields used in your Anki model
-            fields = {
-                "Word": parsed["German"],
-                "Meaning": parsed["English"],
-                "Example_1": parsed.get("Example 1 (DE)", ""),
-                "Translation_1": parsed.get("Example 1 (EN)", ""),
-                "Example_2": parsed.get("Example 2 (DE)", ""),
-                "Translation_2": parsed.get("Example 2 (EN)", ""),
-                "Audio_Word": "", # These will be filled by Anki
-                "Audio_Example_1": "",  
-                "Audio_Example_2": ""
-            }
-
-            res = add_note_to_anki(
-                deck_name=args.deck,
-                model_name="AnkiCardGen",
-                fields=fields,
-                audio_files=audio_files,
-                tags=["auto"],
-                media_folder=anki_media_folder 
-            )
-            
-            if res.get("error"):
-                print(f"Failed to add note: {res['error']}")
+    def unfinished(words):
+        for word in words:
+            if journal.done(word, "written") and (not push_to_anki or journal.done(word, "pushed")):
+                skip("finished")
             else:
-                print(f"Successfully added note for: {parsed['German']}")
+                yield word
 
-        results.append(parsed)
+    # A package holds every card of the run, so finished words are passed on to it again
+    if journal.resumed and not write_apkg:
+        words = unfinished(words)
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-    output_filename = f"anki_cards_{timestamp}.csv"
-    write_csv(output_filename, results)
+    anki_client = None
+    media = None
+    if push_to_anki:
+        anki_client, anki = connect_anki(args)
+        # Without a reachable AnkiConnect there is nothing to transfer the audio to
+        media = make_media_transfer(args, anki_client, anki)
+
+        # Drop words that already have a note before paying for their LLM and TTS work
+        existing_words = fetch_existing_words(anki_client, args.deck, "AnkiCardGen")
+        if existing_words:
+            key = note_match_key(args.dedup)
+            existing_keys = {key(word) for word in existing_words}
+
+            def new_words(words):
+                for word in words:
+                    # Words of a resumed run may already be in the deck but still need their CSV row
+                    if journal.done(word, "generated") or key(word) not in existing_keys:
+                        yield word
+                    else:
+                        skip("existing")
+
+            words = new_words(words)
+
+    def generate_stage(batch):
+        todo = [word for word in batch if not journal.done(word, "generated")]
+        generated = {}
+        if todo:
+            for card in generate_cards(todo, prompt_template, batch_template, args.model, cache=cache, refresh=args.refresh, retry=retry, layout=args.prompt_layout):
+                generated[card["word"]] = card
+                if "parsed" in card:
+                    journal.record(card["word"], "generated", card["parsed"])
+
+        cards = []
+        for word in batch:
+            card = generated.get(word) or {"word": word, "parsed": journal.get(word, "generated")}
+            card["audio_files"] = journal.get(word, "audio")
+            cards.append(card)
+        return cards
+
+    def audio_stage(cards):
+        todo = [
+            card for card in cards
+            if "parsed" in card and not (card["audio_files"] and all(path and os.path.exists(path) for path in card["audio_files"].values()))
+        ]
+        for card, audio_files in zip(todo, generate_card_audio([card["parsed"] for card in todo], tts)):
+            card["audio_files"] = audio_files
+            journal.record(card["word"], "audio", audio_files)
+        return cards
+
+    def anki_stage(cards):
+        if media is not None:
+            # One transfer for the whole batch; build_note then finds every file already in place
+            media.transfer([path for card in cards if card.get("audio_files") for path in card["audio_files"].values()])
+        for card in cards:
+            if "parsed" in card and not journal.done(card["word"], "pushed"):
+                note = build_card_note(card["parsed"], card["audio_files"], args.deck, media, tags=[tag])
+                report_push_results(anki_client.add_note(card["word"], note), journal)
+        return cards
+
+    def apkg_stage(cards):
+        for card in cards:
+            if "parsed" in card:
+                fields = build_card_note(card["parsed"], None, args.deck, None)["fields"]
+                apkg.add_note(fields, card.get("audio_files"), tags=["auto", tag])
+        return cards
+
+    tts = None
+    stages = [Stage("llm", generate_stage, workers=args.workers)]
+    if generate_tts and args.audio_folder:
+        try:
+            tts = make_tts_service(args, media)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+        stages.append(Stage("tts", audio_stage, workers=args.tts_workers or args.workers))
+    if push_to_anki:
+        stages.append(Stage("anki", anki_stage, workers=args.anki_workers))
+    apkg = None
+    if write_apkg:
+        apkg = ApkgWriter(args.apkg_file or f"{os.path.splitext(output_filename)[0]}.apkg", args.deck)
+        stages.append(Stage("apkg", apkg_stage))
+
+    failed_words = []
+    generated_count = 0
+    start_time = time.perf_counter()
+    csv_writer = CardCSVWriter(output_filename, append=journal.resumed)
+    batches = chunked(words, max(1, args.batch_size))
+    pipeline = run_pipeline(batches, stages, threaded=any(stage.workers > 1 for stage in stages))
+    input_error = None
+    total = len(words_source) if isinstance(words_source, list) else None
+    from tqdm import tqdm
+    with tqdm(total=total, desc="Generating cards") as progress:
+        try:
+            for card in finished_cards(pipeline, failed_words, progress):
+                generated_count += 1
+                if not journal.done(card["word"], "written"):
+                    csv_writer.writerow(card["parsed"])
+                    journal.record(card["word"], "written")
+        except (OSError, ValueError) as e:
+            # Reading the vocabulary failed part-way; keep the cards that were finished
+            input_error = e
+
+    elapsed = time.perf_counter() - start_time
+    if isinstance(words_source, VocabReader):
+        print(f"Read {words_source.read} words, dropped {words_source.duplicates} duplicates (--dedup {args.dedup})")
+    if skipped["finished"]:
+        print(f"Skipped {skipped['finished']} words completed before the run was interrupted")
+    if skipped["existing"]:
+        print(f"Skipped {skipped['existing']} words that already exist in deck '{args.deck}'")
+    close_backends(args, tts, cache)
+
+    if anki_client is not None:
+        report_push_results(anki_client.flush(), journal)
+        print(f"AnkiConnect: {anki_client.notes_pushed} notes added in {anki_client.request_count} requests")
+        if media is not None:
+            print(media.summary())
+        anki_client.close()
+
+    if apkg is not None:
+        apkg.close()
+        print(apkg.summary())
+
+    csv_writer.close()
+    journal.close()
     print(f"CSV file '{output_filename}' has been created.")
 
+    write_outputs(args, stages, generated_count, failed_words, elapsed, run_id=journal.run_id)
+    if input_error is not None:
+        print(f"Error reading words: {input_error}")
+        return 1
+    if failed_words:
+        return 1
+
+def sync(args):
+    """
+    Bring the deck in line with the vocabulary for parsed `sync` command line arguments
+
+    Notes are matched to words by their Word field. Words without a note are generated
+    and added; notes whose generation tag differs from the current template, system
+    prompt and model (or that have none) are regenerated and their fields updated in
+    place, keeping their review history. With --delete, notes whose word is no longer in
+    the vocabulary are deleted. Regenerated words still go through the response cache,
+    so only the cards whose prompt or model changed cost an LLM request.
+    """
+    try:
+        words = list(get_words_from_args(args.words, args.vocab, args.vocab_column, args.vocab_delimiter, args.dedup, args.vocab_header))
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    prompt_template = read_prompt_template(args.template)
+    batch_template = read_prompt_template(args.batch_template) if args.batch_size > 1 else None
+    tag = generation_tag(batch_template or prompt_template, SYSTEM_PROMPT, args.model, args.prompt_layout)
+
+    anki_client, anki = connect_anki(args)
+    notes = fetch_notes(anki_client, args.deck, "AnkiCardGen")
+    if notes is None:
+        print(f"Error: Could not read deck '{args.deck}' from AnkiConnect")
+        anki_client.close()
+        return 1
+
+    key = note_match_key(args.dedup)
+    by_key = {}
+    for note in notes:
+        if note["fields"].get("Word"):
+            by_key.setdefault(key(note["fields"]["Word"]), note)
+
+    to_add, to_update, up_to_date = [], {}, 0
+    for word in words:
+        note = by_key.get(key(word))
+        if note is None:
+            to_add.append(word)
+        elif tag in note["tags"]:
+            up_to_date += 1
+        else:
+            to_update[word] = note
+    vocab_keys = {key(word) for word in words}
+    to_delete = [note["id"] for note_key, note in by_key.items() if note_key not in vocab_keys] if args.delete else []
+
+    print(
+        f"Deck '{args.deck}': {len(notes)} notes, {up_to_date} up to date. "
+        f"To add: {len(to_add)}, to update: {len(to_update)}, to delete: {len(to_delete)} (generation tag {tag})"
+    )
+    if args.dry_run or not (to_add or to_update or to_delete):
+        anki_client.close()
+        return 0
+
+    retry, cache = start_llm(args)
+    media = make_media_transfer(args, anki_client, anki)
+    tts = None
+    if not args.no_audio and args.audio_folder:
+        try:
+            tts = make_tts_service(args, media)
+        except ValueError as e:
+            print(f"Error: {e}")
+            anki_client.close()
+            return 1
+
+    to_update_tags = {note["id"]: note["tags"] for note in to_update.values()}
+    pending_updates = []
+    update_errors = []
+    updated = 0
+    update_lock = threading.Lock()
+
+    def flush_updates(min_size=0):
+        nonlocal updated
+        with update_lock:
+            if not pending_updates or len(pending_updates) < min_size:
+                return
+            batch = pending_updates[:]
+            pending_updates.clear()
+        # Tags of earlier generations are replaced by the current one
+        old_tags = {t for note_id, _ in batch for t in to_update_tags[note_id] if t.startswith("cardgen:") and t != tag}
+        results = update_notes(anki_client, batch, add_tag=tag, remove_tags=old_tags, chunk_size=args.anki_batch_size)
+        with update_lock:
+            for note_id, error in results:
+                if error:
+                    update_errors.append((note_id, error))
+                else:
+                    updated += 1
+
+    def generate_stage(batch):
+        return list(generate_cards(batch, prompt_template, batch_template, args.model, cache=cache, refresh=args.refresh, retry=retry, layout=args.prompt_layout))
+
+    def audio_stage(cards):
+        todo = [card for card in cards if "parsed" in card]
+        # Regenerated sentences get new file names; the old clips stay valid for the old card versions
+        for card, audio_files in zip(todo, generate_card_audio([card["parsed"] for card in todo], tts, unique_names=True)):
+            card["audio_files"] = audio_files
+        return cards
+
+    def anki_stage(cards):
+        if media is not None:
+            media.transfer([path for card in cards if card.get("audio_files") for path in card["audio_files"].values()])
+        for card in cards:
+            if "parsed" not in card:
+                continue
+            note = build_card_note(card["parsed"], card.get("audio_files"), args.deck, media, tags=[tag])
+            if card["word"] in to_update:
+                with update_lock:
+                    pending_updates.append((to_update[card["word"]]["id"], note["fields"]))
+            else:
+                report_push_results(anki_client.add_note(card["word"], note))
+        flush_updates(min_size=args.anki_batch_size)
+        return cards
+
+    stages = [Stage("llm", generate_stage, workers=args.workers)]
+    if tts is not None:
+        stages.append(Stage("tts", audio_stage, workers=args.tts_workers or args.workers))
+    stages.append(Stage("anki", anki_stage, workers=args.anki_workers))
+
+    failed_words = []
+    generated_count = 0
+    start_time = time.perf_counter()
+    todo = to_add + list(to_update)
+    batches = chunked(todo, max(1, args.batch_size))
+    pipeline = run_pipeline(batches, stages, threaded=any(stage.workers > 1 for stage in stages))
+    from tqdm import tqdm
+    with tqdm(total=len(todo), desc="Syncing cards") as progress:
+        for _ in finished_cards(pipeline, failed_words, progress):
+            generated_count += 1
+
+    report_push_results(anki_client.flush())
+    flush_updates()
+    for note_id, error in update_errors:
+        print(f"Failed to update note {note_id}: {error}")
+    deleted = delete_notes(anki_client, to_delete) if to_delete else 0
+    elapsed = time.perf_counter() - start_time
+
+    close_backends(args, tts, cache)
+    print(f"AnkiConnect: {anki_client.notes_pushed} notes added, {updated} updated, {deleted} deleted in {anki_client.request_count} requests")
+    if media is not None:
+        print(media.summary())
+    anki_client.close()
+
+    write_outputs(args, stages, generated_count, failed_words, elapsed, retry_command="main.py sync")
+    if failed_words or update_errors or deleted < len(to_delete):
+        return 1
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    raise SystemExit(main())
\ No newline at end of file
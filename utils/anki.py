@@ -1,11 +1,394 @@
-import shutil
+import json
 import os
 import requests
+import requests.adapters
 import textwrap
+import threading
+from contextlib import nullcontext
+
+from utils.concurrency import AdaptiveLimiter
+from utils.media import MediaTransfer
+from utils.metrics import metrics
+from utils.utils import get_anki_media_folder, normalize_word
+
+ANKI_CONNECT_URL = "http://localhost:8765"
+
+# Fields of the note type created by create_model_if_missing, in order
+MODEL_FIELDS = [
+    "Word", "Meaning",
+    "Example_1", "Translation_1",
+    "Example_2", "Translation_2",
+    "Audio_Word", "Audio_Example_1",
+    "Audio_Example_2"
+]
+
+# Card templates and styling of the note type
+MODEL_TEMPLATES = [
+    {
+        "Name": "Target to Native",
+        "Front": "{{Word}}{{Audio_Word}}",
+        "Back": textwrap.dedent("""\
+            {{Meaning}}
+
+            <hr id=answer>
+
+            {{Example_1}}{{Audio_Example_1}} 
+            <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
+                Show Translation
+            </button>
+            <div style="display:none;">
+                <i>{{Translation_1}}</i>
+            </div><br><br>
+
+            {{Example_2}}{{Audio_Example_2}}
+            <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
+                Show Translation
+            </button>
+            <div style="display:none;">
+                <i>{{Translation_2}}</i>
+            </div><br><br>
+        """),
+    },
+    {
+        "Name": "Native to Target",
+        "Front": "{{Meaning}}",
+        "Back": textwrap.dedent("""\
+            {{Word}}{{Audio_Word}}
+
+            <hr id=answer>
+
+            {{Example_1}}{{Audio_Example_1}} 
+            <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
+                Show Translation
+            </button>
+            <div style="display:none;">
+                <i>{{Translation_1}}</i>
+            </div><br><br>
+
+            {{Example_2}}{{Audio_Example_2}}
+            <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
+                Show Translation
+            </button>
+            <div style="display:none;">
+                <i>{{Translation_2}}</i>
+            </div><br><br>
+        """),
+    }
+]
+
+MODEL_CSS = """
+.card {
+    font-family: arial;
+    font-size: 20px;
+    text-align: center;
+    color: black;
+    background-color: white;
+}
+
+audio {
+    width: 100%;
+    max-width: 300px;
+    margin: 5px 0;
+}
+"""
+
+
+class AnkiConnectClient:
+    """AnkiConnect client that reuses pooled connections and pushes notes in batches"""
+
+    def __init__(self, url=ANKI_CONNECT_URL, batch_size=50, timeout=10, pool_size=4, adaptive=False):
+        """
+        Args:
+            url: AnkiConnect endpoint
+            batch_size: Number of buffered notes that triggers a flush
+            timeout: Timeout in seconds for a single request
+            pool_size: Maximum number of pooled connections kept open
+            adaptive: Adapt the number of concurrent requests to AnkiConnect's latency, up to
+                pool_size (see AdaptiveLimiter)
+        """
+        self.url = url
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.limiter = AdaptiveLimiter("anki", max(1, pool_size)) if adaptive else None
+        self.request_count = 0
+        self.notes_pushed = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def request(self, action, params=None, timeout=None):
+        """Send one AnkiConnect action and return the raw response dict ({"result": ..., "error": ...})"""
+        payload = {"action": action, "version": 6}
+        if params is not None:
+            payload["params"] = params
+        with self._lock:
+            self.request_count += 1
+        metrics.incr("anki.requests")
+        try:
+            # Actions take very different times, so the limiter compares each with its own latency
+            with self.limiter.slot(key=action) if self.limiter else nullcontext(), metrics.span(f"anki.{action}"):
+                response = self.session.post(self.url, json=payload, timeout=timeout or self.timeout)
+                if self.limiter is not None:
+                    # Lets the limiter see a 429/5xx as overload
+                    response.raise_for_status()
+            return response.json()
+        except Exception:
+            metrics.incr("anki.request_errors")
+            raise
+
+    def multi(self, actions, timeout=None):
+        """
+        Send several actions in a single request
+
+        Args:
+            actions: List of (action, params) tuples
+
+        Returns:
+            List of raw response dicts, one per action
+        """
+        res = self.request("multi", {
+            "actions": [
+                {"action": action, "version": 6, "params": params or {}}
+                for action, params in actions
+            ]
+        }, timeout=timeout)
+        if res.get("error"):
+            raise RuntimeError(f"AnkiConnect multi request failed: {res['error']}")
+        return res.get("result") or []
+
+    def add_note(self, word, note):
+        """
+        Buffer a note for the next batch, flushing when the buffer is full
+
+        Returns:
+            List of (word, result) pairs for notes flushed by this call (empty while buffering)
+        """
+        with self._lock:
+            self._pending.append((word, note))
+            if len(self._pending) < self.batch_size:
+                return []
+            batch, self._pending = self._pending, []
+        return self._push(batch)
+
+    def flush(self):
+        """Push all buffered notes and return their (word, result) pairs"""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        results = []
+        for start in range(0, len(batch), self.batch_size):
+            results.extend(self._push(batch[start:start + self.batch_size]))
+        return results
+
+    def _push(self, batch):
+        if not batch:
+            return []
+        notes = [note for _, note in batch]
+        try:
+            can_add = self.request("canAddNotes", {"notes": notes}, timeout=self.timeout * 3)
+            if can_add.get("error"):
+                return [(word, {"error": can_add["error"]}) for word, _ in batch]
+
+            results = [None] * len(batch)
+            to_add = []
+            for i, ok in enumerate(can_add.get("result") or []):
+                if ok:
+                    to_add.append(i)
+                else:
+                    results[i] = {"result": "skipped", "reason": "duplicate"}
+
+            if to_add:
+                added = self.request("addNotes", {"notes": [notes[i] for i in to_add]}, timeout=self.timeout * 3)
+                note_ids = added.get("result") or [None] * len(to_add)
+                for i, note_id in zip(to_add, note_ids):
+                    if note_id:
+                        results[i] = {"result": note_id}
+                    else:
+                        results[i] = {"error": added.get("error") or "Note could not be added"}
+                with self._lock:
+                    self.notes_pushed += sum(1 for note_id in note_ids if note_id)
+
+            return [(word, res) for (word, _), res in zip(batch, results)]
+        except requests.exceptions.RequestException as e:
+            return [(word, {"error": f"Failed to connect to AnkiConnect: {e}"}) for word, _ in batch]
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+
+
+def get_default_client():
+    """Shared client used by the module-level helpers"""
+    global _default_client
+    if _default_client is None:
+        _default_client = AnkiConnectClient()
+    return _default_client
+
+
+def fetch_notes(client, deck_name, model_name, chunk_size=500, chunks_per_request=10):
+    """
+    Fetch every note of a model in a deck
+
+    Note ids come from a single findNotes query; their fields are then fetched with
+    notesInfo in chunks, several chunks per multi request.
+
+    Args:
+        client: AnkiConnectClient to use
+        deck_name: Name of the Anki deck
+        model_name: Name of the note type/model
+        chunk_size: Number of notes per notesInfo action
+        chunks_per_request: Number of notesInfo actions sent in one multi request
+
+    Returns:
+        List of {"id", "fields" (name -> value), "tags"} dicts, or None if the deck could not be read
+    """
+    try:
+        res = client.request("findNotes", {"query": f'"deck:{deck_name}" "note:{model_name}"'}, timeout=60)
+        if res.get("error"):
+            print(f"Error searching existing notes: {res['error']}")
+            return None
+        note_ids = res.get("result") or []
+
+        chunks = [note_ids[i:i + chunk_size] for i in range(0, len(note_ids), chunk_size)]
+        notes = []
+        for start in range(0, len(chunks), chunks_per_request):
+            actions = [("notesInfo", {"notes": chunk}) for chunk in chunks[start:start + chunks_per_request]]
+            for chunk_res in client.multi(actions, timeout=120):
+                if chunk_res.get("error"):
+                    print(f"Error fetching existing notes: {chunk_res['error']}")
+                    return None
+                for info in chunk_res.get("result") or []:
+                    notes.append({
+                        "id": info.get("noteId"),
+                        "fields": {name: field.get("value", "") for name, field in info.get("fields", {}).items()},
+                        "tags": info.get("tags", []),
+                    })
+        return notes
+    except (requests.exceptions.RequestException, RuntimeError) as e:
+        print(f"Failed to fetch existing notes from AnkiConnect: {e}")
+        return None
+
+
+def fetch_existing_words(client, deck_name, model_name, chunk_size=500, chunks_per_request=10):
+    """
+    Fetch the normalized Word field of every note of a model in a deck (see fetch_notes)
+
+    Returns:
+        Set of normalized words, or None if the deck could not be read
+    """
+    notes = fetch_notes(client, deck_name, model_name, chunk_size, chunks_per_request)
+    if notes is None:
+        return None
+    return {normalize_word(note["fields"]["Word"]) for note in notes if note["fields"].get("Word")}
+
+
+def update_notes(client, updates, add_tag=None, remove_tags=(), chunk_size=50):
+    """
+    Overwrite the fields of existing notes, many notes per multi request
+
+    Args:
+        client: AnkiConnectClient to use
+        updates: List of (note_id, fields) pairs
+        add_tag: Tag added to every updated note
+        remove_tags: Tags removed from every updated note
+        chunk_size: Number of notes per multi request
+
+    Returns:
+        List of (note_id, error) pairs; error is None for notes that were updated
+    """
+    results = []
+    for start in range(0, len(updates), chunk_size):
+        chunk = updates[start:start + chunk_size]
+        actions = [("updateNoteFields", {"note": {"id": note_id, "fields": fields}}) for note_id, fields in chunk]
+        note_ids = [note_id for note_id, _ in chunk]
+        if remove_tags:
+            actions.append(("removeTags", {"notes": note_ids, "tags": " ".join(sorted(remove_tags))}))
+        if add_tag:
+            actions.append(("addTags", {"notes": note_ids, "tags": add_tag}))
+        try:
+            responses = client.multi(actions, timeout=client.timeout * 3)
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            results += [(note_id, f"Failed to update note: {e}") for note_id in note_ids]
+            continue
+        results += [(note_id, res.get("error")) for note_id, res in zip(note_ids, responses)]
+    return results
+
+
+def delete_notes(client, note_ids, chunk_size=500):
+    """Delete notes in chunks; returns the number of notes deleted"""
+    deleted = 0
+    for start in range(0, len(note_ids), chunk_size):
+        chunk = note_ids[start:start + chunk_size]
+        try:
+            res = client.request("deleteNotes", {"notes": chunk}, timeout=60)
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to delete notes: {e}")
+            break
+        if res.get("error"):
+            print(f"Error deleting notes: {res['error']}")
+            break
+        deleted += len(chunk)
+    return deleted
+
+
+_media_transfers = {}
+_media_transfers_lock = threading.Lock()
+
+
+def _default_media_transfer(media_folder):
+    """MediaTransfer shared by every build_note call that only passes a media folder"""
+    with _media_transfers_lock:
+        if media_folder not in _media_transfers:
+            _media_transfers[media_folder] = MediaTransfer(media_folder)
+        return _media_transfers[media_folder]
+
+
+def build_note(deck_name, model_name, fields, audio_files=None, tags=None, media_folder=None, allow_duplicates=False, media=None):
+    """
+    Build an AnkiConnect note whose audio fields reference files in the Anki media folder
+
+    Args:
+        deck_name: Name of the Anki deck
+        model_name: Name of the note type/model
+        fields: Dict of field names to values
+        audio_files: Dict mapping field names to audio file paths
+        tags: List of tags to add to the note
+        media_folder: Path to Anki's media folder (used when no `media` is given)
+        allow_duplicates: Whether to allow duplicate notes
+        media: MediaTransfer that gets the audio files into Anki
+    """
+    fields = dict(fields)
+    if audio_files and media is None and media_folder:
+        media = _default_media_transfer(media_folder)
+    if audio_files and media is not None and media.strategy is not None:
+        names = media.transfer(audio_files.values())
+        for field_name, audio_path in audio_files.items():
+            if audio_path in names:
+                fields[field_name] = fields.get(field_name, "") + f"[sound:{names[audio_path]}]"
+            else:
+                print(f"Audio file not transferred to Anki: {audio_path}")
+    elif audio_files:
+        print("Warning: Audio files provided but no media folder specified")
+
+    return {
+        "deckName": deck_name,
+        "modelName": model_name,
+        "fields": fields,
+        "options": {
+            "allowDuplicate": allow_duplicates,
+            "duplicateScope": "deck"
+        },
+        "tags": tags or [],
+    }
+
 
 def add_note_to_anki(deck_name, model_name, fields, audio_files=None, tags=None, media_folder=None, allow_duplicates=False):
     """
-    Add a note to Anki with optional audio files
+    Add a single note to Anki with optional audio files
     
     Args:
         deck_name: Name of the Anki deck
@@ -16,17 +399,14 @@ def add_note_to_anki(deck_name, model_name, fields, audio_files=None, tags=None,
         media_folder: Path to Anki's media folder
         allow_duplicates: Whether to allow duplicate notes
     """
-    
+    client = get_default_client()
+
     # First check if note already exists (if duplicates not allowed)
     if not allow_duplicates:
         try:
             # Search for existing notes with the same word
             search_query = f'"deck:{deck_name}" "Word:{fields.get("Word", "")}"'
-            search_res = requests.post("http://localhost:8765", json={
-                "action": "findNotes",
-                "version": 6,
-                "params": {"query": search_query}
-            }, timeout=10).json()
+            search_res = client.request("findNotes", {"query": search_query})
             
             if search_res.get("result") and len(search_res["result"]) > 0:
                 print(f"Note for '{fields.get('Word', '')}' already exists, skipping...")
@@ -34,84 +414,30 @@ def add_note_to_anki(deck_name, model_name, fields, audio_files=None, tags=None,
                 
         except Exception as e:
             print(f"Warning: Could not check for duplicates: {e}")
-    
-    audio_list = []
-    
-    if audio_files and media_folder and os.path.exists(media_folder):
-        for field_name, audio_path in audio_files.items():
-            if audio_path and os.path.exists(audio_path):
-                filename = os.path.basename(audio_path)
-                dest_path = os.path.join(media_folder, filename)
-
-                try:
-                    # Copy file to Anki media folder if it doesn't exist
-                    if not os.path.exists(dest_path):
-                        shutil.copy2(audio_path, dest_path)
-
-                    # Add to audio list for Anki
-                    audio_list.append({
-                        "filename": filename,
-                        "path": dest_path,
-                        "fields": [field_name]
-                    })
-                except Exception as e:
-                    print(f"Error copying audio file {audio_path}: {e}")
-            else:
-                print(f"Audio file not found: {audio_path}")
-    elif audio_files and not media_folder:
-        print("Warning: Audio files provided but no media folder specified")
 
-    payload = {
-        "action": "addNote",
-        "version": 6,
-        "params": {
-            "note": {
-                "deckName": deck_name,
-                "modelName": model_name,
-                "fields": fields,
-                "options": {
-                    "allowDuplicate": allow_duplicates
-                },
-                "tags": tags or [],
-                "audio": audio_list
-            }
-        }
-    }
+    note = build_note(deck_name, model_name, fields, audio_files, tags, media_folder, allow_duplicates)
 
     try:
-        res = requests.post("http://localhost:8765", json=payload, timeout=10).json()
-        return res
+        return client.request("addNote", {"note": note})
     except requests.exceptions.RequestException as e:
         return {"error": f"Failed to connect to AnkiConnect: {e}"}
 
-def create_model_if_missing(model_name):
+def create_model_if_missing(model_name, client=None):
     """Create Anki note type if it doesn't exist"""
     try:
         # Check if model exists
-        res = requests.post("http://localhost:8765", json={
-            "action": "modelNames",
-            "version": 6
-        }, timeout=10).json()
+        client = client or get_default_client()
+        res = client.request("modelNames")
 
         if res.get("error"):
             print(f"Error fetching model names: {res['error']}")
             return
 
-        expected_fields = [
-            "Word", "Meaning",
-            "Example_1", "Translation_1",
-            "Example_2", "Translation_2",
-            "Audio_Word", "Audio_Example_1",
-            "Audio_Example_2"
-        ]
-        
+        expected_fields = MODEL_FIELDS
+
         if model_name in res.get("result", []):
             # Model exists, check if fields match
-            fields_res = requests.post("http://localhost:8765", json={
-                "action": "modelFieldNames",
-                "version": 6,
-                "params": {"modelName": model_name}
-            }, timeout=10).json()
+            fields_res = client.request("modelFieldNames", {"modelName": model_name})
 
             if fields_res.get("error") is None:
                 current_fields = fields_res.get("result", []) 
@@ -129,88 +455,12 @@ def create_model_if_missing(model_name):
                 return    
 
         # Create the model since it doesn't exist
-        templates = [
-            {
-                "Name": "Target to Native",
-                "Front": "{{Word}}{{Audio_Word}}",
-                "Back": textwrap.dedent("""\
-                    {{Meaning}}
-                                        
-                    <hr id=answer>
-
-                    {{Example_1}}{{Audio_Example_1}} 
-                    <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
-                        Show Translation
-                    </button>
-                    <div style="display:none;">
-                        <i>{{Translation_1}}</i>
-                    </div><br><br>
-
-                    {{Example_2}}{{Audio_Example_2}}
-                    <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
-                        Show Translation
-                    </button>
-                    <div style="display:none;">
-                        <i>{{Translation_2}}</i>
-                    </div><br><br>
-                """),
-            },
-            {
-                "Name": "Native to Target",
-                "Front": "{{Meaning}}",
-                "Back": textwrap.dedent("""\
-                    {{Word}}{{Audio_Word}}
-                                        
-                    <hr id=answer>
-
-                    {{Example_1}}{{Audio_Example_1}} 
-                    <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
-                        Show Translation
-                    </button>
-                    <div style="display:none;">
-                        <i>{{Translation_1}}</i>
-                    </div><br><br>
-
-                    {{Example_2}}{{Audio_Example_2}}
-                    <button onclick="this.nextElementSibling.style.display='block'; this.style.display='none';">
-                        Show Translation
-                    </button>
-                    <div style="display:none;">
-                        <i>{{Translation_2}}</i>
-                    </div><br><br>
-                """),
-            }
-        ]
-
-        
-        css_style = """
-        .card {
-            font-family: arial;
-            font-size: 20px;
-            text-align: center;
-            color: black;
-            background-color: white;
-        }
-        
-        audio {
-            width: 100%;
-            max-width: 300px;
-            margin: 5px 0;
-        }
-        """
-
-        model_payload = {
-            "action": "createModel",
-            "version": 6,
-            "params": {
-                "modelName": model_name,
-                "inOrderFields": expected_fields,
-                "css": css_style,  
-                "cardTemplates": templates
-            }
-        }
-
-        res = requests.post("http://localhost:8765", json=model_payload, timeout=10).json()
+        res = client.request("createModel", {
+            "modelName": model_name,
+            "inOrderFields": expected_fields,
+            "css": MODEL_CSS,
+            "cardTemplates": MODEL_TEMPLATES
+        })
         
         if res.get("error"):
             print(f"Error creating model: {res['error']}")
@@ -220,13 +470,11 @@ def create_model_if_missing(model_name):
     except requests.exceptions.RequestException as e:
         print(f"Failed to connect to AnkiConnect: {e}")
 
-def ensure_deck_exists(deck_name):
+def ensure_deck_exists(deck_name, client=None):
     """Create deck if it doesn't exist"""
     try:
-        response = requests.post("http://localhost:8765", json={
-            "action": "deckNames", 
-            "version": 6
-        }, timeout=10).json()
+        client = client or get_default_client()
+        response = client.request("deckNames")
         
         if response.get("error"):
             print(f"Error fetching decks: {response['error']}")
@@ -235,12 +483,7 @@ def ensure_deck_exists(deck_name):
         decks = response.get("result", [])
         if deck_name not in decks:
             # Create deck if missing
-            create_payload = {
-                "action": "createDeck",
-                "version": 6,
-                "params": {"deck": deck_name}
-            }
-            create_response = requests.post("http://localhost:8765", json=create_payload, timeout=10).json()
+            create_response = client.request("createDeck", {"deck": deck_name})
             if create_response.get("error"):
                 print(f"Error creating deck '{deck_name}': {create_response['error']}")
             else:
@@ -249,4 +492,100 @@ def ensure_deck_exists(deck_name):
             print(f"Deck '{deck_name}' already exists")
             
     except requests.exceptions.RequestException as e:
-        print(f"Failed to connect to AnkiConnect: {e}")
\ No newline at end of file
+        print(f"Failed to connect to AnkiConnect: {e}")
+
+def _load_state(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path, state):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+def prepare_anki(client, deck_name, model_name, state_file=None, find_media=False):
+    """
+    Make sure the deck and note type exist, and find Anki's media folder
+
+    What was found is kept in `state_file`, per AnkiConnect URL. One multi request
+    checks the deck and the note type against it; the deck and note type are only
+    created, and the profile folders only scanned, when that check finds something
+    missing or changed.
+
+    Args:
+        client: AnkiConnectClient to use
+        deck_name: Name of the Anki deck
+        model_name: Name of the note type/model
+        state_file: JSON file caching what was found (None to always start from scratch)
+        find_media: Also find the media folder
+
+    Returns:
+        Dict with "deck_id", "fields" (of the note type) and "media_folder" (None if not
+        found or not asked for), or None if AnkiConnect could not be reached
+    """
+    state = _load_state(state_file) if state_file else {}
+    cached = state.get(client.url, {})
+    media_folder = cached.get("media_folder") if find_media else None
+    if media_folder and not os.path.isdir(media_folder):
+        media_folder = None
+
+    actions = [("deckNamesAndIds", {}), ("modelFieldNames", {"modelName": model_name})]
+    if find_media and media_folder is None:
+        actions.append(("getMediaDirPath", {}))
+    try:
+        with metrics.span("anki.prepare"):
+            results = client.multi(actions, timeout=30)
+    except (requests.exceptions.RequestException, RuntimeError) as e:
+        print(f"Failed to connect to AnkiConnect: {e}")
+        return None
+
+    deck_id = (results[0].get("result") or {}).get(deck_name)
+    if deck_id is None:
+        ensure_deck_exists(deck_name, client=client)
+        res = client.request("deckNamesAndIds")
+        deck_id = (res.get("result") or {}).get(deck_name)
+    elif cached.get("decks", {}).get(deck_name) != deck_id:
+        print(f"Deck '{deck_name}' already exists")
+
+    fields = results[1].get("result")
+    if results[1].get("error") or fields is None:
+        # Unknown note type
+        create_model_if_missing(model_name, client=client)
+        fields = client.request("modelFieldNames", {"modelName": model_name}).get("result")
+    elif fields != MODEL_FIELDS:
+        print(f"Note type '{model_name}' exists but fields differ.")
+        print(f"Expected: {MODEL_FIELDS}")
+        print(f"Current: {fields}")
+        print("Please rename your current note type or delete it manually.")
+    elif cached.get("models", {}).get(model_name) != fields:
+        print(f"Note type '{model_name}' already exists with correct fields")
+
+    if find_media and media_folder is None:
+        # AnkiConnect knows the folder of the open profile; it is only usable on this machine
+        media_folder = results[2].get("result")
+        if not media_folder or not os.path.isdir(media_folder):
+            media_folder = get_anki_media_folder()
+        if media_folder and not os.path.isdir(media_folder):
+            media_folder = None
+
+    if state_file:
+        cached = state.setdefault(client.url, {})
+        if deck_id is not None:
+            cached.setdefault("decks", {})[deck_name] = deck_id
+        if fields is not None:
+            cached.setdefault("models", {})[model_name] = fields
+        if media_folder:
+            cached["media_folder"] = media_folder
+        try:
+            _save_state(state_file, state)
+        except OSError as e:
+            print(f"Warning: could not save Anki state to '{state_file}': {e}")
+
+    return {"deck_id": deck_id, "fields": fields, "media_folder": media_folder}
@@ -0,0 +1,240 @@
+import hashlib
+import html
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+
+from utils.anki import MODEL_CSS, MODEL_FIELDS, MODEL_TEMPLATES
+from utils.metrics import metrics
+from utils.utils import normalize_word
+
+# Fixed id of the AnkiCardGen note type, so every package imports into the same note type
+MODEL_ID = 1718400612345
+
+# Anki collection schema 11, the format .apkg packages are read in
+SCHEMA = """
+CREATE TABLE col (
+    id integer primary key, crt integer not null, mod integer not null, scm integer not null,
+    ver integer not null, dty integer not null, usn integer not null, ls integer not null,
+    conf text not null, models text not null, decks text not null, dconf text not null, tags text not null
+);
+CREATE TABLE notes (
+    id integer primary key, guid text not null, mid integer not null, mod integer not null,
+    usn integer not null, tags text not null, flds text not null, sfld integer not null,
+    csum integer not null, flags integer not null, data text not null
+);
+CREATE TABLE cards (
+    id integer primary key, nid integer not null, did integer not null, ord integer not null,
+    mod integer not null, usn integer not null, type integer not null, queue integer not null,
+    due integer not null, ivl integer not null, factor integer not null, reps integer not null,
+    lapses integer not null, left integer not null, odue integer not null, odid integer not null,
+    flags integer not null, data text not null
+);
+CREATE TABLE revlog (
+    id integer primary key, cid integer not null, usn integer not null, ease integer not null,
+    ivl integer not null, lastIvl integer not null, factor integer not null, time integer not null,
+    type integer not null
+);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn ON notes (usn);
+CREATE INDEX ix_cards_usn ON cards (usn);
+CREATE INDEX ix_revlog_usn ON revlog (usn);
+CREATE INDEX ix_cards_nid ON cards (nid);
+CREATE INDEX ix_cards_sched ON cards (did, queue, due);
+CREATE INDEX ix_revlog_cid ON revlog (cid);
+CREATE INDEX ix_notes_csum ON notes (csum);
+"""
+
+_TAGS = re.compile(r"<[^>]*>|\[sound:[^\]]*\]")
+
+# Already compressed audio is stored as is; deflating it only costs time
+_STORED_EXTENSIONS = {".mp3", ".ogg", ".opus", ".m4a"}
+
+
+def _strip(text):
+    return html.unescape(_TAGS.sub("", text)).strip()
+
+
+def _checksum(text):
+    """Anki's duplicate check: first 8 hex digits of the SHA-1 of the stripped first field"""
+    return int(hashlib.sha1(_strip(text).encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _guid(deck_name, word):
+    """Stable note guid, so importing a newer package updates the notes of an older one"""
+    return hashlib.sha256(f"{deck_name}\x1f{normalize_word(word)}".encode("utf-8")).hexdigest()[:10]
+
+
+def _deck_id(deck_name):
+    return int(hashlib.sha256(deck_name.encode("utf-8")).hexdigest()[:12], 16) + 1
+
+
+def _model(deck_id, now):
+    def field(i, name):
+        return {"name": name, "ord": i, "font": "Arial", "size": 20, "rtl": False, "sticky": False, "media": []}
+
+    def template(i, tmpl):
+        return {"name": tmpl["Name"], "ord": i, "qfmt": tmpl["Front"], "afmt": tmpl["Back"], "bqfmt": "", "bafmt": "", "did": None}
+
+    def required(tmpl):
+        return [i for i, name in enumerate(MODEL_FIELDS) if f"{{{{{name}}}}}" in tmpl["Front"]]
+
+    return {
+        "id": MODEL_ID,
+        "name": "AnkiCardGen",
+        "type": 0,
+        "mod": now,
+        "usn": -1,
+        "sortf": 0,
+        "did": deck_id,
+        "tmpls": [template(i, tmpl) for i, tmpl in enumerate(MODEL_TEMPLATES)],
+        "flds": [field(i, name) for i, name in enumerate(MODEL_FIELDS)],
+        "css": MODEL_CSS,
+        "latexPre": "\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n"
+                    "\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n",
+        "latexPost": "\\end{document}",
+        "req": [[i, "any", required(tmpl)] for i, tmpl in enumerate(MODEL_TEMPLATES)],
+        "tags": [],
+        "vers": [],
+    }
+
+
+def _deck(deck_id, name, now):
+    return {
+        "id": deck_id, "name": name, "mod": now, "usn": -1, "desc": "", "dyn": 0, "conf": 1, "collapsed": False,
+        "extendNew": 10, "extendRev": 50, "newToday": [0, 0], "revToday": [0, 0], "lrnToday": [0, 0], "timeToday": [0, 0],
+    }
+
+
+_DECK_CONF = {
+    "1": {
+        "id": 1, "name": "Default", "mod": 0, "usn": 0, "maxTaken": 60, "autoplay": True, "timer": 0, "replayq": True,
+        "dyn": False,
+        "new": {"bury": True, "delays": [1, 10], "initialFactor": 2500, "ints": [1, 4, 7], "order": 1, "perDay": 20, "separate": True},
+        "rev": {"bury": True, "ease4": 1.3, "fuzz": 0.05, "ivlFct": 1, "maxIvl": 36500, "minSpace": 1, "perDay": 200},
+        "lapse": {"delays": [10], "leechAction": 0, "leechFails": 8, "minInt": 1, "mult": 0},
+    }
+}
+
+
+class ApkgWriter:
+    """
+    Writes notes of the AnkiCardGen note type into an .apkg package, without Anki running
+
+    Notes go into a temporary SQLite collection inside one transaction as they arrive; on
+    close the collection and the audio files are streamed into the zip. Importing the
+    package into Anki creates the deck and note type, or updates notes imported before.
+    """
+
+    def __init__(self, path, deck_name):
+        """
+        Args:
+            path: .apkg file to write
+            deck_name: Name of the deck the cards go into
+        """
+        self.path = path
+        self.deck_name = deck_name
+        self.deck_id = _deck_id(deck_name)
+        self.notes = 0
+        self.media = {}
+        self.media_written = 0
+        self._now = int(time.time())
+        self._next_id = int(time.time() * 1000)
+        self._guids = set()
+        self._lock = threading.Lock()
+        self._dir = tempfile.TemporaryDirectory(prefix="cardgen_apkg_", dir=os.path.dirname(os.path.abspath(path)))
+        self._db_path = os.path.join(self._dir.name, "collection.anki2")
+        self._conn = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.executescript(SCHEMA)
+        self._conn.execute("BEGIN")
+        self._write_collection()
+
+    def _write_collection(self):
+        now_ms = self._now * 1000
+        decks = {"1": _deck(1, "Default", self._now), str(self.deck_id): _deck(self.deck_id, self.deck_name, self._now)}
+        conf = {
+            "activeDecks": [self.deck_id], "curDeck": self.deck_id, "curModel": MODEL_ID, "nextPos": 1,
+            "newSpread": 0, "collapseTime": 1200, "timeLim": 0, "estTimes": True, "dueCounts": True,
+            "sortType": "noteFld", "sortBackwards": False, "addToCur": True,
+        }
+        self._conn.execute(
+            "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+            (self._now, now_ms, now_ms, json.dumps(conf), json.dumps({str(MODEL_ID): _model(self.deck_id, self._now)}),
+             json.dumps(decks), json.dumps(_DECK_CONF)),
+        )
+
+    def add_note(self, fields, audio_files=None, tags=None):
+        """
+        Add one note with a card for each template
+
+        Args:
+            fields: Dict of field names to values (missing fields are left empty)
+            audio_files: Dict mapping field names to audio file paths, added as [sound:...] tags
+            tags: List of tags
+
+        Returns:
+            False if a note with the same word was already added, True otherwise
+        """
+        fields = dict(fields)
+        for field_name, audio_path in (audio_files or {}).items():
+            if audio_path:
+                name = os.path.basename(audio_path)
+                fields[field_name] = fields.get(field_name, "") + f"[sound:{name}]"
+        values = [fields.get(name, "") for name in MODEL_FIELDS]
+        guid = _guid(self.deck_name, values[0])
+        tag_text = f" {' '.join(tags)} " if tags else ""
+
+        with self._lock:
+            if guid in self._guids:
+                return False
+            self._guids.add(guid)
+            for path in (audio_files or {}).values():
+                if path:
+                    self.media.setdefault(os.path.basename(path), path)
+            note_id = self._next_id
+            self._next_id += 1 + len(MODEL_TEMPLATES)
+            self._conn.execute(
+                "INSERT INTO notes VALUES (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')",
+                (note_id, guid, MODEL_ID, self._now, tag_text, "\x1f".join(values), _strip(values[0]), _checksum(values[0])),
+            )
+            self._conn.executemany(
+                "INSERT INTO cards VALUES (?, ?, ?, ?, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+                [(note_id + 1 + i, note_id, self.deck_id, i, self._now, self.notes + 1) for i in range(len(MODEL_TEMPLATES))],
+            )
+            self.notes += 1
+        return True
+
+    def close(self):
+        """Commit the collection and write the package"""
+        with self._lock:
+            self._conn.execute("COMMIT")
+            self._conn.close()
+        with metrics.span("apkg.write", notes=self.notes, media=len(self.media)):
+            tmp = f"{self.path}.tmp"
+            media_index = {}
+            with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as package:
+                package.write(self._db_path, "collection.anki2")
+                for i, (name, path) in enumerate(sorted(self.media.items())):
+                    if not os.path.exists(path):
+                        print(f"Audio file missing, not added to the package: {path}")
+                        continue
+                    extension = os.path.splitext(name)[1].lower()
+                    # ZipFile.write copies the file in chunks, so large media never sit in memory
+                    package.write(path, str(i), compress_type=zipfile.ZIP_STORED if extension in _STORED_EXTENSIONS else zipfile.ZIP_DEFLATED)
+                    media_index[str(i)] = name
+                package.writestr("media", json.dumps(media_index))
+            os.replace(tmp, self.path)
+        self._dir.cleanup()
+        self.media_written = len(media_index)
+        return self.path
+
+    def summary(self):
+        """One-line summary for the end of the run"""
+        return f"Anki package '{self.path}': {self.notes} notes, {self.media_written} audio files"
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils.metrics import metrics
+
+
+def response_cache_key(word, prompt_template, system_prompt, model, sampling_params, layout="template"):
+    """Content-addressed key for an LLM response: changes whenever anything that shapes the output changes"""
+    payload = {
+        "word": word,
+        "prompt_template": prompt_template,
+        "system_prompt": system_prompt,
+        "model": model,
+        "sampling_params": sampling_params,
+    }
+    if layout != "template":
+        # Only added for other layouts, so entries cached before layouts existed stay valid
+        payload["layout"] = layout
+    payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def generation_tag(prompt_template, system_prompt, model, layout="template"):
+    """
+    Anki tag recording the prompt and model a note was generated with (e.g. cardgen:1a2b3c4d5e6f)
+
+    Sync compares it with the tag of the current settings to find the notes to regenerate.
+
+    Args:
+        prompt_template: Template the cards are generated from (the batch template when batching)
+        system_prompt: System prompt
+        model: Model identifier
+        layout: Prompt layout (see PROMPT_LAYOUTS)
+    """
+    payload = json.dumps([prompt_template, system_prompt, model, layout], ensure_ascii=False)
+    return f"cardgen:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]}"
+
+
+class ResponseCache:
+    """On-disk SQLite cache of raw LLM responses and their parsed cards"""
+
+    def __init__(self, cache_dir, max_size_mb=None, max_age_days=None):
+        """
+        Args:
+            cache_dir: Folder holding the cache database (created if missing)
+            max_size_mb: Evict least recently used entries once the cache grows beyond this size
+            max_age_days: Evict entries that were created more than this many days ago
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "responses.sqlite3")
+        self.max_size = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                word TEXT NOT NULL,
+                raw TEXT NOT NULL,
+                parsed TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+        self.evict()
+
+    def get(self, *keys):
+        """Return (raw_response, parsed) for the first of the keys present, or None on a miss"""
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute("SELECT raw, parsed FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    break
+            else:
+                self.misses += 1
+                metrics.incr("cache.misses")
+                return None
+            self.hits += 1
+            metrics.incr("cache.hits")
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return row[0], json.loads(row[1])
+
+    def put(self, key, word, raw, parsed):
+        """Store a raw response and its parsed card"""
+        parsed_json = json.dumps(parsed, ensure_ascii=False)
+        size = len(raw.encode("utf-8")) + len(parsed_json.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, word, raw, parsed, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, word, raw, parsed_json, size, now, now),
+            )
+            self._conn.commit()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until the cache fits max_size"""
+        with self._lock:
+            if self.max_age:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+            if self.max_size:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_size:
+                    rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+                    evicted = []
+                    for key, size in rows:
+                        if total <= self.max_size:
+                            break
+                        evicted.append((key,))
+                        total -= size
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            self._conn.commit()
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,145 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.metrics import metrics
+
+
+def is_overload_error(error):
+    """
+    Whether an error says the backend is overloaded rather than the request being bad
+
+    Timeouts, HTTP 429 and HTTP 5xx count as overload, whichever client raised them
+    (openai, requests, gTTS).
+    """
+    if isinstance(error, TimeoutError) or "Timeout" in type(error).__name__:
+        return True
+    for holder in (error, getattr(error, "response", None), getattr(error, "rsp", None)):
+        status = getattr(holder, "status_code", None)
+        if isinstance(status, int):
+            return status == 429 or status >= 500
+    return False
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of concurrent calls to one backend
+
+    Starts at `initial` and, while the smoothed latency stays within `tolerance` times the
+    lowest latency seen, raises the limit: by one per call until the first backoff (slow
+    start), then by one per round of `limit` calls. Latency growth beyond that, or a call
+    that failed with an overload error, multiplies the limit by `backoff`, at most once per
+    round. Latency is tracked per `key`, so calls of different kinds (AnkiConnect actions)
+    are only compared with their own kind.
+
+    The limit is published as the gauge concurrency.<name>.limit, and its peak as
+    concurrency.<name>.peak.
+    """
+
+    def __init__(self, name, max_limit, initial=1, min_limit=1, tolerance=1.5, backoff=0.7, smoothing=0.3, baseline_decay=0.001):
+        """
+        Args:
+            name: Backend name used in the gauges
+            max_limit: Upper bound of the limit (usually the number of worker threads)
+            initial: Limit to start with
+            min_limit: Lower bound of the limit
+            tolerance: Smoothed latency over lowest latency ratio above which the limit backs off
+            backoff: Factor applied to the limit when backing off
+            smoothing: Weight of a new latency sample in the moving average
+            baseline_decay: Fraction by which the lowest latency drifts up per call, so a
+                stale minimum is forgotten when the backend gets slower for good
+        """
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.baseline_decay = baseline_decay
+        self.in_flight = 0
+        self.peak = int(self.limit)
+        self._slow_start = True
+        self._latency = {}
+        self._started = 0
+        self._hold_until = 0
+        self._condition = threading.Condition()
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge(f"concurrency.{self.name}.limit", int(self.limit))
+        metrics.set_gauge(f"concurrency.{self.name}.peak", self.peak)
+
+    def acquire(self):
+        """Wait for a free slot; returns the call's sequence number for release"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self._started += 1
+            return self._started
+
+    def release(self, started, latency, key=None, overload=False):
+        """
+        Free a slot and adjust the limit
+
+        Args:
+            started: Sequence number returned by acquire
+            latency: Duration of the call in seconds (None if it failed without a usable latency)
+            key: Kind of call the latency is compared with
+            overload: Whether the call failed because the backend is overloaded
+        """
+        with self._condition:
+            self.in_flight -= 1
+            congested = overload
+            if latency is not None and not overload:
+                baseline, average = self._latency.get(key, (latency, latency))
+                baseline = min(baseline * (1 + self.baseline_decay), latency)
+                average += self.smoothing * (latency - average)
+                self._latency[key] = (baseline, average)
+                congested = average > baseline * self.tolerance
+
+            if congested:
+                # Calls started before the last backoff still see the old load; don't react to them twice
+                if started > self._hold_until:
+                    self._decrease()
+            elif latency is not None and self.in_flight + 1 >= int(self.limit):
+                # Only a limit that was actually reached says anything about the backend
+                self._increase()
+            self._condition.notify_all()
+
+    def _increase(self):
+        if self.limit >= self.max_limit:
+            return
+        old = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + (1 if self._slow_start else 1 / self.limit))
+        if int(self.limit) > old:
+            self.peak = max(self.peak, int(self.limit))
+            self._publish()
+
+    def _decrease(self):
+        self._slow_start = False
+        self._hold_until = self._started
+        old = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        if int(self.limit) < old:
+            metrics.incr(f"concurrency.{self.name}.backoffs")
+            self._publish()
+
+    @contextmanager
+    def slot(self, key=None, units=1):
+        """
+        Hold a slot for the duration of a call, feeding its outcome back into the limit
+
+        Args:
+            key: Kind of call, see release
+            units: Amount of work in the call; the latency is divided by it (e.g. clips in a batch)
+        """
+        started = self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.release(started, None, key, overload=is_overload_error(e))
+            raise
+        self.release(started, (time.perf_counter() - start) / max(1, units), key)
@@ -0,0 +1,108 @@
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+# Stages a word goes through, in order; "written" means its CSV row is on disk
+STAGES = ["generated", "audio", "pushed", "written"]
+
+
+def new_run_id():
+    """Timestamp plus a random suffix, so runs started in the same second get their own journal"""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(2)}"
+
+
+class RunJournal:
+    """
+    Append-only JSONL log of the stages each word has completed in a run
+
+    The first line holds the run metadata, every following line records one stage
+    completion for one word. Lines are flushed as soon as they are written, so after a
+    crash the journal tells exactly which work can be skipped when the run is resumed.
+    Only the completed stages of each word, and where their records are in the file, are
+    kept in memory; the recorded cards and audio paths are read back from disk when needed.
+    """
+
+    def __init__(self, runs_dir, run_id, meta=None, resume=False):
+        """
+        Args:
+            runs_dir: Folder holding the journals
+            run_id: Run identifier
+            meta: Metadata stored with a new run (ignored when resuming)
+            resume: Continue the existing journal of run_id; otherwise a new journal is
+                created, and an existing one with the same id is an error (FileExistsError)
+        """
+        os.makedirs(runs_dir, exist_ok=True)
+        self.run_id = run_id
+        self.path = os.path.join(runs_dir, f"{run_id}.jsonl")
+        self.resumed = resume
+        self.meta = meta or {}
+        # word -> {stage: offset of the record in the file}
+        self.states = {}
+        self._lock = threading.Lock()
+        self._reader = None
+        if resume:
+            self._load()
+            self._file = open(self.path, "ab")
+        else:
+            self._file = open(self.path, "xb")
+            self._write({"meta": self.meta})
+
+    def _load(self):
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in iter(f.readline, b""):
+                offset = end
+                if not line.endswith(b"\n"):
+                    # A crash can leave a truncated last line behind
+                    break
+                end += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "meta" in entry:
+                    self.meta = entry["meta"]
+                else:
+                    self.states.setdefault(entry["word"], {})[entry["stage"]] = offset
+        # Cut the truncated line off, so the next record starts on a line of its own
+        if end < os.path.getsize(self.path):
+            os.truncate(self.path, end)
+
+    def _write(self, entry):
+        offset = self._file.tell()
+        self._file.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._file.flush()
+        return offset
+
+    def record(self, word, stage, data=None):
+        """Record that `word` completed `stage` (see STAGES), with the stage's output"""
+        with self._lock:
+            offset = self._write({"word": word, "stage": stage, "data": data, "time": time.time()})
+            self.states.setdefault(word, {})[stage] = offset
+
+    def done(self, word, stage):
+        """Whether `word` already completed `stage`"""
+        return stage in self.states.get(word, {})
+
+    def get(self, word, stage):
+        """Output recorded for a completed stage (None if it was not completed)"""
+        offset = self.states.get(word, {}).get(stage)
+        if offset is None:
+            return None
+        with self._lock:
+            if self._reader is None:
+                self._reader = open(self.path, "rb")
+            self._reader.seek(offset)
+            line = self._reader.readline()
+        return json.loads(line).get("data")
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            if self._reader is not None:
+                self._reader.close()
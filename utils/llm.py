@@ -0,0 +1,339 @@
+import threading
+import time
+from contextlib import nullcontext
+
+from utils.concurrency import AdaptiveLimiter
+from utils.metrics import metrics
+
+# openai is imported when the first client is made: it takes most of a second to import,
+# which runs that only read words or check Anki should not pay for
+
+LLM_BASE_URL = "http://localhost:1234/v1"
+LLM_API_KEY = "lm-studio"
+
+
+def is_failover_error(error):
+    """
+    Whether an error says something is wrong with the server rather than the request
+
+    The request is then sent to another endpoint and the failing one is taken out of
+    rotation for a while.
+    """
+    from openai import APIConnectionError, InternalServerError
+    return isinstance(error, (APIConnectionError, InternalServerError))
+
+
+def parse_endpoint(spec):
+    """
+    Split an endpoint spec "URL" or "URL=WEIGHT" into (url, weight)
+
+    The weight is the endpoint's share of the concurrent requests (default 1).
+    """
+    url, sep, weight = spec.rpartition("=")
+    if sep and weight.replace(".", "", 1).isdigit() and float(weight) > 0:
+        return url, float(weight)
+    return spec, 1.0
+
+
+class Endpoint:
+    """One OpenAI-compatible server with its clients, health and throughput statistics"""
+
+    def __init__(self, base_url, weight=1.0, timeout=None, max_retries=2, limiter=None):
+        """
+        Args:
+            base_url: OpenAI-compatible server URL
+            weight: Share of the concurrent requests routed to this endpoint
+            timeout: Request timeout in seconds (None = client default)
+            max_retries: Retries done by the client itself before an error is reported
+            limiter: AdaptiveLimiter bounding the concurrent requests to this endpoint
+        """
+        self.base_url = base_url
+        self.weight = weight
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = limiter
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.completion_tokens = 0
+        self.busy_time = 0.0
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0.0
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        """Long-lived client, shared by every thread so connections are pooled"""
+        with self._lock:
+            if self._client is None:
+                from openai import OpenAI
+                options = {"timeout": self.timeout} if self.timeout is not None else {}
+                self._client = OpenAI(base_url=self.base_url, api_key=LLM_API_KEY, max_retries=self.max_retries, **options)
+            return self._client
+
+    def complete(self, model, messages, sampling_params, stream_parser=None):
+        """Blocking chat completion on this endpoint, see chat_completion"""
+        client = self.client()
+        if stream_parser is None:
+            response = client.chat.completions.create(model=model, messages=messages, **sampling_params)
+            return response.choices[0].message.content or "", response.usage
+
+        stream = client.chat.completions.create(model=model, messages=messages, stream=True, **sampling_params)
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content and stream_parser.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            # Closing the stream drops the connection, which makes the server stop generating
+            stream.close()
+        return stream_parser.text, None
+
+    def ping(self, timeout=5.0):
+        """Health check: whether the server answers a model listing"""
+        try:
+            self.client().with_options(timeout=timeout, max_retries=0).models.list()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class LLMRouter:
+    """
+    Spreads requests over several endpoints
+
+    Each request goes to the healthy endpoint with the fewest outstanding requests
+    relative to its weight. An endpoint that fails with a server or connection error is
+    taken out of rotation; a background thread pings it with growing intervals and puts
+    it back once it answers again.
+    """
+
+    def __init__(self, endpoints, health_interval=5.0, max_health_interval=60.0):
+        """
+        Args:
+            endpoints: List of Endpoint objects
+            health_interval: Seconds before a failed endpoint is first checked again
+            max_health_interval: Upper bound for the doubling check interval of an endpoint that stays down
+        """
+        self.endpoints = endpoints
+        self.health_interval = health_interval
+        self.max_health_interval = max_health_interval
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+        if len(endpoints) > 1:
+            self._health_thread = threading.Thread(target=self._health_loop, name="llm-health", daemon=True)
+            self._health_thread.start()
+
+    def acquire(self, exclude=()):
+        """Pick the endpoint for a request and count it as outstanding (None if all are excluded)"""
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            if not candidates:
+                return None
+            # With every endpoint down, try the one that is due for a check first rather than failing outright
+            pool = [endpoint for endpoint in candidates if endpoint.healthy] or [min(candidates, key=lambda e: e.retry_at)]
+            # Endpoints with an adaptive limit go last once they are at it
+            endpoint = min(pool, key=lambda e: (e.limiter is not None and e.outstanding >= int(e.limiter.limit), e.outstanding / e.weight, -e.weight))
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _mark_down(self, endpoint):
+        endpoint.failures += 1
+        endpoint.healthy = False
+        endpoint.retry_at = time.monotonic() + min(self.max_health_interval, self.health_interval * 2 ** (endpoint.failures - 1))
+
+    def release(self, endpoint, elapsed, usage=None, error=None):
+        """Record the outcome of a request sent to `endpoint`"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.busy_time += elapsed
+            if usage is not None:
+                endpoint.completion_tokens += usage.completion_tokens or 0
+            if error is None:
+                endpoint.healthy = True
+                endpoint.failures = 0
+                return
+            endpoint.errors += 1
+            if is_failover_error(error):
+                self._mark_down(endpoint)
+        if is_failover_error(error):
+            metrics.incr("llm.endpoint_failures")
+
+    def _health_loop(self):
+        while not self._stop.wait(min(1.0, self.health_interval)):
+            for endpoint in self.endpoints:
+                if endpoint.healthy or time.monotonic() < endpoint.retry_at:
+                    continue
+                ok = endpoint.ping()
+                with self._lock:
+                    if ok:
+                        endpoint.healthy = True
+                        endpoint.failures = 0
+                    else:
+                        self._mark_down(endpoint)
+
+    def report(self):
+        """Per-endpoint statistics as a JSON-serializable list"""
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            return [
+                {
+                    "url": endpoint.base_url,
+                    "weight": endpoint.weight,
+                    "requests": endpoint.requests,
+                    "errors": endpoint.errors,
+                    "completion_tokens": endpoint.completion_tokens,
+                    "requests_per_sec": endpoint.requests / elapsed if elapsed else 0.0,
+                    "mean_latency": endpoint.busy_time / endpoint.requests if endpoint.requests else 0.0,
+                    "healthy": endpoint.healthy,
+                    "concurrency_limit": int(endpoint.limiter.limit) if endpoint.limiter else None,
+                }
+                for endpoint in self.endpoints
+            ]
+
+    def summary(self):
+        """One line per endpoint for the run summary"""
+        return "\n".join(
+            f"  {stats['url']} (weight {stats['weight']:g}): {stats['requests']} requests, "
+            f"{stats['requests_per_sec']:.2f} req/s, {stats['mean_latency']:.2f}s mean, "
+            f"{stats['errors']} errors, {stats['completion_tokens']} completion tokens"
+            + ("" if stats["healthy"] else " [down]")
+            for stats in self.report()
+        )
+
+    def close(self):
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+
+class LLMSettings:
+    """How chat_completion reaches the LLM servers; configured once per run with configure_llm"""
+
+    def __init__(self):
+        self.stream = False
+        self.router = None
+        self._lock = threading.Lock()
+
+    def get_router(self):
+        """Router of the configured endpoints (a single default endpoint if configure_llm was not called)"""
+        with self._lock:
+            if self.router is None:
+                self.router = LLMRouter([Endpoint(LLM_BASE_URL)])
+            return self.router
+
+
+llm_settings = LLMSettings()
+
+
+def configure_llm(base_url=LLM_BASE_URL, max_in_flight=8, stream=False, timeout=None, adaptive=False):
+    """
+    Set up the LLM connections for this run
+
+    Args:
+        base_url: OpenAI-compatible server URL, or a list of "URL" / "URL=WEIGHT" specs to
+            balance the requests between
+        max_in_flight: Maximum number of concurrent requests when adaptive is set, shared
+            between the endpoints by weight
+        stream: Stream responses and stop them as soon as every card field has been received
+        timeout: Request timeout in seconds (None = client default)
+        adaptive: Adapt the number of concurrent requests to each endpoint to its latency,
+            up to its share of max_in_flight (see AdaptiveLimiter)
+    """
+    close_llm()
+    specs = [base_url] if isinstance(base_url, str) else list(base_url)
+    endpoints = [parse_endpoint(spec) for spec in specs]
+    total_weight = sum(weight for _, weight in endpoints)
+    shares = [max(1, round(max_in_flight * weight / total_weight)) for _, weight in endpoints]
+    llm_settings.stream = stream
+    llm_settings.router = LLMRouter([
+        Endpoint(
+            url,
+            weight,
+            timeout=timeout,
+            # With other endpoints to fail over to, don't let the client retry a dead server
+            max_retries=2 if len(endpoints) == 1 else 0,
+            limiter=AdaptiveLimiter("llm" if len(endpoints) == 1 else f"llm[{url}]", share) if adaptive else None,
+        )
+        for (url, weight), share in zip(endpoints, shares)
+    ])
+
+
+def close_llm():
+    """Close the LLM connections; the endpoint statistics stay available until the next configure_llm"""
+    if llm_settings.router is not None:
+        llm_settings.router.close()
+
+
+def llm_endpoint_report():
+    """Per-endpoint statistics of the configured router (see LLMRouter.report)"""
+    return llm_settings.get_router().report()
+
+
+def llm_endpoint_summary():
+    """Per-endpoint throughput lines for the run summary"""
+    return llm_settings.get_router().summary()
+
+
+def chat_completion(model, messages, sampling_params, stream_parser=None, cards=1):
+    """
+    Run a chat completion on the least loaded healthy endpoint
+
+    A request that fails with a server or connection error is sent to the next endpoint,
+    unless part of a streamed response was already consumed.
+
+    Args:
+        model: Model identifier
+        messages: Chat messages
+        sampling_params: Keyword arguments for chat.completions.create
+        stream_parser: Incremental parser with feed(chunk) -> done and a `text` attribute. When
+            streaming is enabled, the response is dropped as soon as feed() returns True
+        cards: Number of cards the request asks for; the adaptive limiter compares batched
+            and single-card requests separately, by their latency per card
+
+    Returns:
+        (response text, usage) - usage is None for streamed responses
+    """
+    if not llm_settings.stream:
+        stream_parser = None
+    router = llm_settings.get_router()
+    tried = []
+    while True:
+        endpoint = router.acquire(exclude=tried)
+        metrics.incr("llm.requests")
+        start = time.perf_counter()
+        try:
+            limit = endpoint.limiter.slot(key="batch" if cards > 1 else "single", units=cards) if endpoint.limiter else nullcontext()
+            with limit:
+                # Waiting for a slot is left out of the endpoint latency and the llm.request span
+                start = time.perf_counter()
+                with metrics.span("llm.request", model=model, endpoint=endpoint.base_url):
+                    text, usage = endpoint.complete(model, messages, sampling_params, stream_parser)
+        except Exception as e:
+            router.release(endpoint, time.perf_counter() - start, error=e)
+            metrics.incr("llm.request_errors")
+            tried.append(endpoint)
+            partial = stream_parser is not None and stream_parser.first_chunk_at is not None
+            if not is_failover_error(e) or partial or len(tried) == len(router.endpoints):
+                raise
+            metrics.incr("llm.failovers")
+            continue
+        router.release(endpoint, time.perf_counter() - start, usage)
+        break
+
+    if stream_parser is not None and stream_parser.first_chunk_at is not None:
+        # Time to first token: dominated by prompt processing, which prefix caching cuts
+        metrics.observe("llm.ttft", stream_parser.first_chunk_at - start)
+    if stream_parser is not None and stream_parser.complete:
+        metrics.incr("llm.streams_cut_short")
+    return text, usage
@@ -0,0 +1,235 @@
+import base64
+import os
+import shutil
+import tempfile
+import threading
+from urllib.parse import urlparse
+
+import requests
+
+from utils.metrics import metrics
+
+# "auto" picks the first of hardlink/reflink/copy that works between the audio folder and
+# the media folder, or "store" when the media folder is unknown. "direct" has the TTS stage
+# place clips straight in the media folder instead of the audio folder.
+MEDIA_STRATEGIES = ["auto", "hardlink", "reflink", "copy", "direct", "store"]
+
+# Linux ioctl that shares the extents of one file with another (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def reflink(src, dest):
+    """Copy-on-write clone of src at dest; raises OSError where the filesystem can't do it"""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dest, "xb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dest)
+            raise
+
+
+def _hardlink_or_copy(src, dest):
+    """Hard link src at dest, copying where that fails; dest is a new name in the media folder, not replaced atomically"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+_PLACE = {
+    "hardlink": os.link,
+    "reflink": reflink,
+    "copy": shutil.copy2,
+    # Clips that were not synthesized into the media folder (e.g. from an earlier run) are linked in
+    "direct": _hardlink_or_copy,
+}
+
+
+def _probe(strategy, source_folder, media_folder):
+    """Whether `strategy` can place a file from source_folder into media_folder"""
+    fd, src = tempfile.mkstemp(prefix=".cardgen_probe_", dir=source_folder)
+    os.close(fd)
+    dest = os.path.join(media_folder, os.path.basename(src))
+    try:
+        _PLACE[strategy](src, dest)
+        return True
+    except OSError:
+        return False
+    finally:
+        for path in (src, dest):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class MediaTransfer:
+    """
+    Gets audio files into Anki's collection.media once per file name
+
+    The media folder is listed once when the transfer is created; files already in it
+    are never touched again. Notes then reference the files with [sound:...] tags, so
+    AnkiConnect does not read or copy them a second time.
+    """
+
+    def __init__(self, media_folder=None, strategy="auto", client=None, source_folder=None):
+        """
+        Args:
+            media_folder: Path to Anki's media folder (None if unknown)
+            strategy: One of MEDIA_STRATEGIES
+            client: AnkiConnectClient, needed for the "store" strategy
+            source_folder: Folder the audio files come from, used to probe the fastest strategy
+        """
+        if media_folder and not os.path.isdir(media_folder):
+            media_folder = None
+        self.media_folder = media_folder
+        self.client = client
+        self.strategy = self._resolve(strategy, source_folder)
+        self.transferred = 0
+        self.already_present = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._names = {}
+        self.existing = self._list_existing()
+
+    def _resolve(self, strategy, source_folder):
+        if strategy == "auto":
+            if self.media_folder is None:
+                return "store" if self.client is not None else None
+            if source_folder and os.path.isdir(source_folder):
+                for candidate in ("hardlink", "reflink"):
+                    if _probe(candidate, source_folder, self.media_folder):
+                        return candidate
+            return "copy"
+        if strategy == "store":
+            if self.client is None:
+                raise ValueError("the store media strategy needs an AnkiConnect client")
+        elif self.media_folder is None:
+            return "store" if self.client is not None else None
+        return strategy
+
+    def _list_existing(self):
+        """Names of the files already in the media folder (from AnkiConnect if the folder is unknown)"""
+        if self.strategy is None:
+            return set()
+        if self.media_folder is not None:
+            with os.scandir(self.media_folder) as entries:
+                return {entry.name for entry in entries}
+        try:
+            res = self.client.request("getMediaFilesNames", {"pattern": "*"}, timeout=60)
+        except requests.exceptions.RequestException as e:
+            # Without AnkiConnect there is nowhere to store the files
+            print(f"Warning: could not reach AnkiConnect to list media files, audio will not be transferred: {e}")
+            self.strategy = None
+            return set()
+        if res.get("error"):
+            print(f"Warning: could not list Anki media files: {res['error']}")
+            return set()
+        return set(res.get("result") or [])
+
+    def transfer(self, paths):
+        """
+        Make sure the audio files are in Anki's media folder
+
+        Args:
+            paths: Audio file paths (None entries are ignored)
+
+        Returns:
+            Dict mapping each path that is available to Anki to its media file name
+        """
+        if self.strategy is None:
+            return {}
+
+        names = {}
+        todo = []
+        with self._lock:
+            for path in paths:
+                if not path or path in names:
+                    continue
+                if path in self._names:
+                    names[path] = self._names[path]
+                    continue
+                name = os.path.basename(path)
+                names[path] = name
+                if name in self.existing:
+                    self.already_present += 1
+                    metrics.incr("media.already_present")
+                else:
+                    # Claimed now so concurrent batches don't transfer the same file twice
+                    self.existing.add(name)
+                    todo.append(path)
+
+        if todo:
+            with metrics.span("media.transfer", strategy=self.strategy, files=len(todo)):
+                if self.strategy == "store":
+                    failed = self._store(todo, names)
+                else:
+                    failed = self._place(todo)
+            with self._lock:
+                self.transferred += len(todo) - len(failed)
+                self.errors += len(failed)
+                for path in failed:
+                    self.existing.discard(names.pop(path))
+            metrics.incr("media.transferred", len(todo) - len(failed))
+            if failed:
+                metrics.incr("media.errors", len(failed))
+        with self._lock:
+            self._names.update(names)
+        return names
+
+    def _place(self, paths):
+        failed = []
+        for path in paths:
+            dest = os.path.join(self.media_folder, os.path.basename(path))
+            try:
+                if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.media_folder):
+                    _PLACE[self.strategy](path, dest)
+            except FileExistsError:
+                # Added by Anki itself since the folder was listed
+                pass
+            except OSError as e:
+                print(f"Error transferring audio file {path}: {e}")
+                failed.append(path)
+        return failed
+
+    def _store(self, paths, names, chunk_size=50):
+        """Upload files with storeMediaFile, many per multi request, updating `names` to the stored names"""
+        # AnkiConnect on this machine can read the files itself; a remote one needs their bytes
+        local = urlparse(self.client.url).hostname in ("localhost", "127.0.0.1", "::1")
+        failed = []
+        for start in range(0, len(paths), chunk_size):
+            chunk = paths[start:start + chunk_size]
+            actions = []
+            for path in chunk:
+                params = {"filename": names[path]}
+                if local:
+                    params["path"] = os.path.abspath(path)
+                else:
+                    with open(path, "rb") as f:
+                        params["data"] = base64.b64encode(f.read()).decode("ascii")
+                actions.append(("storeMediaFile", params))
+            try:
+                results = self.client.multi(actions, timeout=120)
+            except Exception as e:
+                print(f"Error uploading audio files to AnkiConnect: {e}")
+                failed.extend(chunk)
+                continue
+            for path, res in zip(chunk, results):
+                if res.get("error"):
+                    print(f"Error uploading audio file {path}: {res['error']}")
+                    failed.append(path)
+                elif res.get("result"):
+                    names[path] = res["result"]
+        return failed
+
+    def summary(self):
+        """One-line summary for the end of the run"""
+        return (
+            f"Media [{self.strategy}]: {self.transferred} files transferred, "
+            f"{self.already_present} already in Anki, {self.errors} failed"
+        )
@@ -0,0 +1,156 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Histogram:
+    """Collects observed values and summarizes them as percentiles"""
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def summary(self):
+        values = sorted(self.values)
+        if not values:
+            return {"count": 0, "total": 0.0, "min": 0.0, "p50": 0.0, "p90": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+        pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        return {
+            "count": len(values),
+            "total": sum(values),
+            "min": values[0],
+            "p50": pick(0.50),
+            "p90": pick(0.90),
+            "p95": pick(0.95),
+            "p99": pick(0.99),
+            "max": values[-1],
+        }
+
+
+class Metrics:
+    """
+    Thread-safe counters, histograms and timing spans for a run
+
+    Every span is observed in the histogram of the same name (in seconds). When tracing is
+    enabled, spans are also kept as Chrome trace events (see write_chrome_trace).
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.trace_events = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable_tracing(self):
+        self.trace_events = []
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def set_gauge(self, name, value):
+        """Record the latest value of something that goes up and down (e.g. a concurrency limit)"""
+        with self._lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def span(self, name, **args):
+        """Time a block of code, recording it in the `name` histogram and the trace"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.observe(name, end - start)
+            if self.trace_events is not None:
+                event = {
+                    "name": name,
+                    "cat": name.split(".")[0],
+                    "ph": "X",
+                    "ts": (start - self._start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                }
+                if args:
+                    event["args"] = args
+                with self._lock:
+                    self.trace_events.append(event)
+
+    def histogram_summary(self, name):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            return histogram.summary() if histogram else Histogram().summary()
+
+    def report(self):
+        """Counters, gauges and histogram summaries as a JSON-serializable dict"""
+        with self._lock:
+            names = sorted(self.histograms)
+            counters = dict(sorted(self.counters.items()))
+            gauges = dict(sorted(self.gauges.items()))
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": {name: self.histogram_summary(name) for name in names},
+        }
+
+    def write_chrome_trace(self, path):
+        """Write the spans in Chrome trace format (open with chrome://tracing or ui.perfetto.dev)"""
+        with self._lock:
+            events = list(self.trace_events or [])
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for tid in {event["tid"] for event in events}:
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread_names.get(tid, str(tid))}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+metrics = Metrics()
+
+
+class ThreadProfiler:
+    """cProfile for the calling thread and every thread started while it is active"""
+
+    def __init__(self):
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _start_thread_profile(self, *_):
+        # Called once as the profile hook of a new thread; cProfile then replaces the hook
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self._start_thread_profile)
+        self._start_thread_profile()
+
+    def stop(self):
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # Profiles of threads that never ran any Python code have no stats
+                pass
+        return stats
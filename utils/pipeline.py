@@ -0,0 +1,156 @@
+import queue
+import threading
+
+from utils.metrics import metrics
+
+_DONE = object()
+
+
+class Stage:
+    """A single step of the card pipeline, run by its own pool of worker threads"""
+
+    def __init__(self, name, func, workers=1, queue_size=None):
+        """
+        Args:
+            name: Stage name, used in error messages
+            func: Callable taking the item produced by the previous stage and returning the next one
+            workers: Number of threads running this stage concurrently
+            queue_size: Maximum number of items waiting in front of this stage (default: 2 * workers)
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = queue_size or 2 * self.workers
+
+    def run(self, value):
+        """Apply the stage function, timing it as a `stage.<name>` span"""
+        with metrics.span(f"stage.{self.name}"):
+            return self.func(value)
+
+    def latency_summary(self):
+        """Count, total and percentiles (in seconds) of the per-item durations of this stage"""
+        return metrics.histogram_summary(f"stage.{self.name}")
+
+
+class StageError(Exception):
+    """Raised in place of a result when a stage failed for an item"""
+
+    def __init__(self, stage, error):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+def chunked(items, size):
+    """Lazily group an iterable into lists of at most `size` items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _run_serial(items, stages):
+    for item in items:
+        value = item
+        try:
+            for stage in stages:
+                try:
+                    value = stage.run(value)
+                except Exception as e:
+                    raise StageError(stage.name, e) from e
+        except StageError as e:
+            value = e
+        yield item, value
+
+
+def _stage_worker(stage, inbox, outbox, done_markers, remaining, lock):
+    while True:
+        packet = inbox.get()
+        if packet is _DONE:
+            break
+        index, item, value = packet
+        if not isinstance(value, StageError):
+            try:
+                value = stage.run(value)
+            except Exception as e:
+                value = StageError(stage.name, e)
+        outbox.put((index, item, value))
+
+    # The last worker of a stage to finish tells every consumer of the next queue to stop
+    with lock:
+        remaining[0] -= 1
+        last = remaining[0] == 0
+    if last:
+        for _ in range(done_markers):
+            outbox.put(_DONE)
+
+
+def _feed(items, outbox, done_markers, errors):
+    try:
+        for index, item in enumerate(items):
+            outbox.put((index, item, item))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for _ in range(done_markers):
+            outbox.put(_DONE)
+
+
+def run_pipeline(items, stages, threaded=True):
+    """
+    Push every item through the stages and yield (item, result) pairs in input order.
+
+    With threaded=True each stage runs on its own worker threads and hands items to the
+    next stage through a bounded queue, so a slow stage applies backpressure instead of
+    buffering the whole input. A stage that raises does not stop the run: the item skips
+    the remaining stages and its result is a StageError.
+
+    Args:
+        items: Iterable of input items (consumed lazily)
+        stages: List of Stage objects, applied in order
+        threaded: Run stages concurrently (False runs everything in the calling thread)
+    """
+    if not threaded:
+        yield from _run_serial(items, stages)
+        return
+
+    # Each stage reads from its own bounded queue; the last one writes to the results queue
+    queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+    queues.append(queue.Queue(maxsize=stages[-1].queue_size))
+    consumers = [stage.workers for stage in stages] + [1]
+
+    feed_errors = []
+    threads = [threading.Thread(target=_feed, args=(items, queues[0], consumers[0], feed_errors), daemon=True)]
+    for i, stage in enumerate(stages):
+        remaining = [stage.workers]
+        lock = threading.Lock()
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(
+                target=_stage_worker,
+                args=(stage, queues[i], queues[i + 1], consumers[i + 1], remaining, lock),
+                daemon=True,
+            ))
+
+    for thread in threads:
+        thread.start()
+
+    # Re-order finished items so results come out in the same order they went in
+    pending = {}
+    next_index = 0
+    results = queues[-1]
+    while True:
+        packet = results.get()
+        if packet is _DONE:
+            break
+        index, item, value = packet
+        pending[index] = (item, value)
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index += 1
+
+    if feed_errors:
+        raise feed_errors[0]
@@ -0,0 +1,39 @@
+import random
+import time
+
+
+class RetryPolicy:
+    """Bounded retries with exponential backoff, jitter and an escalation schedule for bad LLM output"""
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0, jitter=0.5, retry_temperature=0.0):
+        """
+        Args:
+            max_attempts: Total number of attempts per word, including the first one
+            base_delay: Backoff in seconds before the first retry after a failed request (doubles every retry)
+            max_delay: Upper bound of the backoff in seconds
+            jitter: Fraction of the backoff that is randomized, so parallel workers don't retry in lockstep
+            retry_temperature: Sampling temperature used once the model has produced invalid output
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_temperature = retry_temperature
+
+    def delay(self, retry):
+        """Backoff in seconds before the given retry (1 = first retry)"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def sleep(self, retry):
+        time.sleep(self.delay(retry))
+
+
+class GenerationError(Exception):
+    """Raised when a word still has no valid card after every allowed attempt"""
+
+    def __init__(self, word, attempts, last_error):
+        super().__init__(f"gave up after {attempts} attempts: {last_error}")
+        self.word = word
+        self.attempts = attempts
+        self.last_error = last_error
@@ -1,29 +1,366 @@
-from gtts import gTTS
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Protocol
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import wave
 
-def generate_audio(text: str, filename_base: str, audio_folder: str = "audio", lang: str = "de") -> str:
+from utils.concurrency import AdaptiveLimiter
+from utils.metrics import metrics
+
+
+class TTSBackend(Protocol):
+    """A speech engine able to write clips for a batch of texts"""
+
+    name: str
+    extension: str
+    # Whether a batch costs less than its clips one by one (e.g. one process for all of them);
+    # clips of other engines are synthesized in parallel instead
+    supports_batch: bool
+
+    def cache_id(self) -> str:
+        """Identifier of the engine and voice, part of the clip cache key"""
+        ...
+
+    def synthesize_batch(self, items: list[tuple[str, Path]], lang: str):
+        """Write one clip per (text, path) pair"""
+        ...
+
+
+class GTTSBackend:
+    """Google Translate TTS (remote, one request per clip)"""
+
+    name = "gtts"
+    extension = ".mp3"
+    supports_batch = False
+
+    def cache_id(self) -> str:
+        return self.name
+
+    def synthesize_batch(self, items, lang):
+        from gtts import gTTS
+
+        for text, path in items:
+            gTTS(text=text, lang=lang).save(str(path))
+
+
+class PiperBackend:
+    """Local piper voice; a whole batch is synthesized by a single piper process"""
+
+    name = "piper"
+    extension = ".wav"
+    supports_batch = True
+
+    def __init__(self, model: str, executable: str = "piper"):
+        if not model:
+            raise ValueError("The piper engine needs a voice model (--piper-model)")
+        self.model = model
+        self.executable = executable
+
+    def cache_id(self) -> str:
+        return f"{self.name}:{os.path.basename(self.model)}"
+
+    def synthesize_batch(self, items, lang):
+        lines = "".join(
+            json.dumps({"text": text, "output_file": str(path)}, ensure_ascii=False) + "\n"
+            for text, path in items
+        )
+        subprocess.run(
+            [self.executable, "--model", self.model, "--json-input"],
+            input=lines.encode("utf-8"),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+
+
+class EspeakBackend:
+    """Local espeak-ng voice (one process per clip, but no network and no model download)"""
+
+    name = "espeak"
+    extension = ".wav"
+    supports_batch = False
+
+    def __init__(self, executable: str = "espeak-ng"):
+        self.executable = executable
+
+    def cache_id(self) -> str:
+        return self.name
+
+    def synthesize_batch(self, items, lang):
+        for text, path in items:
+            subprocess.run(
+                [self.executable, "-v", lang, "-w", str(path), text],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+
+
+class FakeBackend:
+    """Deterministic silent clips for offline runs and benchmarks"""
+
+    name = "fake"
+    extension = ".wav"
+    supports_batch = False
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency: Seconds to sleep per clip, to mimic a real engine
+        """
+        self.latency = latency
+
+    def cache_id(self) -> str:
+        return self.name
+
+    def synthesize_batch(self, items, lang):
+        for text, path in items:
+            if self.latency:
+                time.sleep(self.latency)
+            # Clip length depends only on the text, so identical inputs give identical files
+            frames = 800 * (1 + len(text) % 16)
+            with wave.open(str(path), "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(16000)
+                f.writeframes(b"\0\0" * frames)
+
+
+TTS_ENGINES = ["gtts", "piper", "espeak", "fake"]
+
+
+def get_tts_backend(engine: str = "gtts", piper_model: str = None, fake_latency: float = 0.0) -> TTSBackend:
+    """Create the backend for a --tts-engine name"""
+    if engine == "gtts":
+        return GTTSBackend()
+    if engine == "piper":
+        return PiperBackend(piper_model)
+    if engine == "espeak":
+        return EspeakBackend()
+    if engine == "fake":
+        return FakeBackend(latency=fake_latency)
+    raise ValueError(f"Unknown TTS engine '{engine}' (expected one of: {', '.join(TTS_ENGINES)})")
+
+
+class RateLimiter:
+    """Spaces out calls so that at most `rate` of them start per second (thread-safe)"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def tts_cache_key(text: str, lang: str, engine: str) -> str:
+    """Content hash identifying a synthesized clip"""
+    return hashlib.sha256(f"{engine}\0{lang}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(src: Path, dest: Path):
+    """Make dest point at the cached clip, replacing whatever it held before"""
+    if dest.exists():
+        try:
+            if os.path.samefile(src, dest):
+                return
+        except OSError:
+            pass
+    tmp = dest.with_name(f".{dest.name}.{threading.get_ident()}.tmp")
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+class TTSService:
+    """
+    TTS synthesis with a content-hash cache, in-run deduplication and a bounded thread pool
+
+    Clips are cached under `cache_folder` by hash of (text, lang, engine) and linked to
+    `{audio_folder}/{filename_base}{ext}`, so re-runs and repeated sentences never hit the
+    TTS engine twice. Uncached clips requested together are handed to the backend as one batch.
+    """
+
+    def __init__(self, audio_folder: str = "audio", lang: str = "de", max_workers: int = 4, rate_limit: float = None, cache_folder: str = None, backend: TTSBackend = None, adaptive: bool = False):
+        """
+        Args:
+            audio_folder: Folder to save audio files
+            lang: Language code for TTS
+            max_workers: Maximum number of concurrent synthesis batches
+            rate_limit: Maximum number of clips synthesized per second (None = unlimited)
+            cache_folder: Folder for cached clips (default: {audio_folder}/.tts_cache)
+            backend: Speech engine (default: gTTS)
+            adaptive: Adapt the number of concurrent synthesis batches to the engine's latency,
+                up to max_workers (see AdaptiveLimiter)
+        """
+        self.audio_folder = Path(audio_folder)
+        self.lang = lang
+        self.backend = backend or GTTSBackend()
+        self.cache_folder = Path(cache_folder) if cache_folder else self.audio_folder / ".tts_cache"
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.limiter = AdaptiveLimiter("tts", max(1, max_workers)) if adaptive else None
+        self.cache_hits = 0
+        self.deduplicated = 0
+        self.synthesized = 0
+        self.batches = 0
+        self.synthesis_time = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="tts")
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _synthesize(self, batch):
+        """Synthesize a batch of (cached_path, text, future) and resolve the futures"""
+        try:
+            # A single clip (engines without batching) waits for its own turn right before it starts
+            for _ in batch:
+                self.rate_limiter.wait()
+            tmp_paths = [cached.with_name(f".{cached.name}.{threading.get_ident()}.tmp{cached.suffix}") for cached, _, _ in batch]
+            start = time.perf_counter()
+            items = [(text, tmp) for (_, text, _), tmp in zip(batch, tmp_paths)]
+            # Batches differ in size, so the limiter compares the time per clip
+            with self.limiter.slot(units=len(batch)) if self.limiter else nullcontext():
+                with metrics.span("tts.synthesize", engine=self.backend.name, clips=len(batch)):
+                    self.backend.synthesize_batch(items, self.lang)
+            elapsed = time.perf_counter() - start
+            metrics.incr("tts.clips_synthesized", len(batch))
+            for (cached, _, _), tmp in zip(batch, tmp_paths):
+                os.replace(tmp, cached)
+            with self._lock:
+                self.batches += 1
+                self.synthesized += len(batch)
+                self.synthesis_time += elapsed
+        except Exception as e:
+            metrics.incr("tts.errors")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for cached, _, future in batch:
+            future.set_result(cached)
+
+    def _forget(self, key):
+        """Drop a finished synthesis from the in-flight table; later requests find the clip on disk"""
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def _clip_futures(self, texts):
+        """
+        Futures for the cached clips of `texts`
+
+        Missing clips are synthesized in one batch if the engine supports it, otherwise
+        each clip is a task of its own so the clips run in parallel.
+        """
+        futures = []
+        batch = []
+        with self._lock:
+            for text in texts:
+                key = tts_cache_key(text, self.lang, self.backend.cache_id())
+                future = self._inflight.get(key)
+                if future is not None:
+                    self.deduplicated += 1
+                    metrics.incr("tts.deduplicated")
+                    futures.append(future)
+                    continue
+
+                future = Future()
+                cached = self.cache_folder / f"{key}{self.backend.extension}"
+                if cached.exists():
+                    self.cache_hits += 1
+                    metrics.incr("tts.cache_hits")
+                    future.set_result(cached)
+                else:
+                    batch.append((cached, text, future))
+                    self._inflight[key] = future
+                    future.add_done_callback(lambda _, key=key: self._forget(key))
+                futures.append(future)
+        if batch and self.backend.supports_batch:
+            self._executor.submit(self._synthesize, batch)
+        else:
+            for clip in batch:
+                self._executor.submit(self._synthesize, [clip])
+        return futures
+
+    def generate_many(self, items: list[tuple[str, str]]) -> list[str]:
+        """
+        Generate several clips in parallel
+
+        Args:
+            items: List of (text, filename_base) pairs
+
+        Returns:
+            Absolute audio file paths in the same order (None for clips that failed)
+        """
+        futures = self._clip_futures([text for text, _ in items])
+        paths = []
+        for (text, filename_base), future in zip(items, futures):
+            audio_path = self.audio_folder / f"{filename_base}{self.backend.extension}"
+            try:
+                with metrics.span("tts.wait"):
+                    cached = future.result()
+                _link_or_copy(cached, audio_path)
+                paths.append(str(audio_path.resolve()))  # Return absolute path
+            except Exception as e:
+                print(f"Error generating audio for '{text}': {e}")
+                paths.append(None)
+        return paths
+
+    def generate(self, text: str, filename_base: str) -> str:
+        """Generate a single clip and return its absolute path"""
+        return self.generate_many([(text, filename_base)])[0]
+
+    def summary(self) -> str:
+        """One-line timing summary for the run report"""
+        per_clip = self.synthesis_time / self.synthesized if self.synthesized else 0.0
+        return (
+            f"TTS [{self.backend.name}]: {self.synthesized} clips synthesized in {self.batches} batches "
+            f"({self.synthesis_time:.1f}s, {per_clip:.2f}s/clip), "
+            f"{self.cache_hits} cache hits, {self.deduplicated} duplicates collapsed"
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def generate_audio(text: str, filename_base: str, audio_folder: str = "audio", lang: str = "de", engine: str = "gtts") -> str:
     """
     Generate TTS audio file and return the full path
-    
+
     Args:
         text: Text to convert to speech
         filename_base: Base filename without extension
         audio_folder: Folder to save audio files
         lang: Language code for TTS
-    
+        engine: TTS engine name (see TTS_ENGINES)
+
     Returns:
         Full path to the generated audio file
     """
-    filename = f"{filename_base}.mp3"
-    audio_path = Path(audio_folder) / filename
-    
-    # Create directory if it doesn't exist
-    audio_path.parent.mkdir(parents=True, exist_ok=True)
-    
-    try:
-        tts = gTTS(text=text, lang=lang)
-        tts.save(str(audio_path))
-        return str(audio_path.resolve())  # Return absolute path
-    except Exception as e:
-        print(f"Error generating audio for '{text}': {e}")
-        return None
\ No newline at end of file
+    with _services_lock:
+        service = _services.get((audio_folder, lang, engine))
+        if service is None:
+            service = TTSService(audio_folder, lang, backend=get_tts_backend(engine))
+            _services[(audio_folder, lang, engine)] = service
+    return service.generate(text, filename_base)
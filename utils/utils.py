@@ -1,6 +1,12 @@
 import os
 import csv
-from openai import OpenAI
+import html
+import re
+import threading
+import time
+from functools import lru_cache
+
+from utils.llm import chat_completion
 
 def get_anki_media_folder():
     """Get the Anki media folder path by scanning for available profiles"""
@@ -64,71 +70,345 @@ def read_words(filename: str) -> list[str]:
     with open(filename, "r", encoding="utf-8") as f:
         return [line.strip() for line in f if line.strip()]
 
+def normalize_word(word: str) -> str:
+    """Canonical form of a word for duplicate checks: no HTML, single spaces, case-folded"""
+    word = re.sub(r"<[^>]+>", " ", html.unescape(word))
+    return " ".join(word.split()).casefold()
+
+REQUIRED_KEYS = ["German", "English", "Example 1 (DE)", "Example 1 (EN)", "Example 2 (DE)", "Example 2 (EN)"]
+
+def is_complete_card(card: dict) -> bool:
+    """Whether every required field of a parsed card is non-empty"""
+    return all(card.get(k) for k in REQUIRED_KEYS)
+
 def read_prompt_template(filename: str) -> str:
     with open(filename, "r", encoding="utf-8") as f:
         return f.read()
 
+SYSTEM_PROMPT = """You are a German language tutor creating Anki flashcards. You must respond ONLY in the exact format requested with NO extra text, explanations, or additional content."""
+
+SAMPLING_PARAMS = {
+    "temperature": 0.1,
+    "max_tokens": 400,
+    "stop": [
+        "\n\nGerman:",      # Exactly what the model generates
+        "\nGerman:",        # Alternative without double newline
+        "\n\nWord:",        # Other potential continuations
+        "\nNext word:",
+        "\n\n---",
+        "---"
+    ],
+    "top_p": 0.9,
+    "frequency_penalty": 0.1,
+}
+
+# Batched requests produce several cards, so the single-card stop sequences would cut them short
+BATCH_SAMPLING_PARAMS = {
+    "temperature": 0.1,
+    "max_tokens": 400,  # Per card, multiplied by the batch size
+    "stop": ["\n\n---"],
+    "top_p": 0.9,
+    "frequency_penalty": 0.1,
+}
+
+class TokenUsage:
+    """Thread-safe tally of the tokens spent on LLM requests"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cards = 0
+        self.unmetered = 0
+        self._lock = threading.Lock()
+
+    def add(self, usage):
+        """Record the `usage` block of a chat completion (ignored if the server sent none)"""
+        with self._lock:
+            self.requests += 1
+            if usage is not None:
+                self.prompt_tokens += usage.prompt_tokens or 0
+                self.completion_tokens += usage.completion_tokens or 0
+            else:
+                self.unmetered += 1
+
+    def add_cards(self, count: int):
+        """Record cards produced by the LLM (cache hits excluded)"""
+        with self._lock:
+            self.cards += count
+
+    def summary(self) -> str:
+        total = self.prompt_tokens + self.completion_tokens
+        per_card = total / self.cards if self.cards else 0.0
+        return (
+            f"LLM: {self.requests} requests, {self.cards} cards, {total} tokens "
+            f"({self.prompt_tokens} prompt + {self.completion_tokens} completion), "
+            f"{per_card:.0f} tokens per card"
+            + (f" ({self.unmetered} streamed requests did not report tokens)" if self.unmetered else "")
+        )
+
+token_usage = TokenUsage()
+
+# How prompts are laid out in the chat messages:
+#   prefix   - system prompt and every static part of the template form one byte-identical
+#              system message; the per-word line comes last, so the server can reuse the
+#              KV cache of the prefix across words (llama.cpp / LM Studio prompt caching)
+#   template - system prompt, then the whole template with the word filled in
+PROMPT_LAYOUTS = ["prefix", "template"]
+
+@lru_cache(maxsize=None)
+def split_prompt(prompt: str) -> tuple[str, str]:
+    """Split a prompt template into its static part and the template of the per-word suffix
+
+    The line holding the {} placeholder is moved out of the template, together with the
+    line introducing it when the placeholder stands on a line of its own. A list bullet
+    in front of it is dropped.
+    """
+    lines = prompt.split("\n")
+    for i, line in enumerate(lines):
+        if "{}" in line:
+            start = i - 1 if line.strip() == "{}" and i > 0 else i
+            break
+    else:
+        return prompt.strip(), "{}"
+    suffix = re.sub(r"^\s*[-*]\s+", "", "\n".join(lines[start:i + 1]))
+    static = "\n".join(lines[:start] + lines[i + 1:]).strip()
+    return static, suffix
+
+def build_messages(prompt: str, filler: str, layout: str = "template") -> list[dict]:
+    """Chat messages asking `prompt` about `filler` (a word or a numbered word list)"""
+    if layout == "prefix":
+        static, suffix = split_prompt(prompt)
+        return [
+            {"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{static}"},
+            {"role": "user", "content": suffix.format(filler)},
+        ]
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt.format(filler)},
+    ]
+
 def response_lmstudio(
     word: str,
     prompt: str,
-    model: str="lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF/Meta-Llama-3.1-8B-Instruct-Q8_0.gguf"
+    model: str="lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF/Meta-Llama-3.1-8B-Instruct-Q8_0.gguf",
+    temperature: float=None,
+    feedback: tuple[str, str]=None,
+    layout: str="template",
 ) -> str:
-    """Get the response from the lmstudio backend."""
-    
-    system_prompt = """You are a German language tutor creating Anki flashcards. You must respond ONLY in the exact format requested with NO extra text, explanations, or additional content."""
-    
-    user_prompt = prompt.format(word)
+    """Get the response from the lmstudio backend.
+
+    Args:
+        temperature: Override the default sampling temperature
+        feedback: (previous response, error) pair shown to the model so it can fix its last answer
+        layout: How the prompt is laid out in the messages (see PROMPT_LAYOUTS)
+    """
     
-    client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
+    messages = build_messages(prompt, word, layout)
+    if feedback:
+        previous_response, error = feedback
+        messages += [
+            {"role": "assistant", "content": previous_response},
+            {"role": "user", "content": f"Your answer was invalid: {error}. Respond again with the complete card in the exact format requested."},
+        ]
+
+    sampling_params = dict(SAMPLING_PARAMS)
+    if temperature is not None:
+        sampling_params["temperature"] = temperature
     
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.1,
-        max_tokens=400,
-        stop=[
-            "\n\nGerman:",      # Exactly what the model generates
-            "\nGerman:",        # Alternative without double newline
-            "\n\nWord:",        # Other potential continuations
-            "\nNext word:",
-            "\n\n---",
-            "---"
-        ],
-        top_p=0.9,
-        frequency_penalty=0.1,
-    ).choices[0].message.content
+    response, usage = chat_completion(model, messages, sampling_params, stream_parser=CardStreamParser())
+    token_usage.add(usage)
     
     return response.strip()
 
+def response_lmstudio_batch(
+    words: list[str],
+    prompt: str,
+    model: str="lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF/Meta-Llama-3.1-8B-Instruct-Q8_0.gguf",
+    layout: str="template",
+) -> str:
+    """Get the cards for several words from a single lmstudio request."""
+
+    word_list = "\n".join(f"{i}. {word}" for i, word in enumerate(words, 1))
+    sampling_params = dict(BATCH_SAMPLING_PARAMS, max_tokens=BATCH_SAMPLING_PARAMS["max_tokens"] * len(words))
+    messages = build_messages(prompt, word_list, layout)
+    response, usage = chat_completion(model, messages, sampling_params, stream_parser=CardStreamParser(len(words)), cards=len(words))
+    token_usage.add(usage)
+
+    return response.strip()
+
+# parse_card finds a field by the text before the first ":" of a line. Clean lines are
+# looked up as they are; anything else is squeezed down to a lookup key first: markdown
+# emphasis and whitespace are deleted, case is folded and a leading list bullet or number
+# is dropped, so "1. **Example 1 (de)**:" and "Example 1 (DE):" are the same field
+_KEY_NOISE = re.compile(r"[\s*_`]+")
+_KEY_PREFIX = "0123456789.)-+>•"
+_VALUE_NOISE = " \t\r*`"
+_FIELD_KEYS = {key: key for key in REQUIRED_KEYS}
+_FIELD_KEYS.update({_KEY_NOISE.sub("", key).lower(): key for key in REQUIRED_KEYS})
+
+def _field_key(head: str) -> str:
+    """Card field named by the text before a line's first ":" (None if it names no field)"""
+    key = _FIELD_KEYS.get(head)
+    if key is None:
+        key = _FIELD_KEYS.get(_KEY_NOISE.sub("", head).lower().lstrip(_KEY_PREFIX))
+    return key
+
+def parse_card(text: str, word: str = None) -> tuple[dict, list[dict]]:
+    """Parse the LM output of one card in a single pass and validate it
+
+    The first occurrence of each field wins, so a model that keeps going with a second
+    card does not overwrite the first one.
+
+    Args:
+        text: Raw LM output
+        word: Word the card was requested for; when given, the German field must be about it
+
+    Returns:
+        (card, errors) - card has every key of REQUIRED_KEYS (empty when not found); errors
+        is a list of {"field": ..., "problem": ...} dicts, empty for a valid card. Problems
+        are "missing" (no such line), "empty" (line without a value), "untranslated" (an
+        English example identical to the German one) and "wrong_word" (card about another word)
+    """
+    card = dict.fromkeys(REQUIRED_KEYS, "")
+    seen = set()
+    for line in text.splitlines():
+        head, colon, value = line.partition(":")
+        if not colon:
+            continue
+        key = _field_key(head)
+        if key is not None and key not in seen:
+            seen.add(key)
+            card[key] = value.strip(_VALUE_NOISE)
+
+    errors = []
+    for key in REQUIRED_KEYS:
+        if not card[key]:
+            errors.append({"field": key, "problem": "empty" if key in seen else "missing"})
+    for n in (1, 2):
+        german, english = card[f"Example {n} (DE)"], card[f"Example {n} (EN)"]
+        if german and german == english:
+            errors.append({"field": f"Example {n} (EN)", "problem": "untranslated"})
+    if word is not None and card["German"] and not card_matches_word(card, word):
+        errors.append({"field": "German", "problem": "wrong_word", "expected": word})
+    return card, errors
+
+_PROBLEMS = {
+    "missing": "the \"{field}:\" line is missing",
+    "empty": "the \"{field}:\" line has no value",
+    "untranslated": "\"{field}\" repeats the German sentence instead of translating it",
+    "wrong_word": "the card is not about the word \"{expected}\"",
+}
+
+def describe_card_errors(errors: list[dict]) -> str:
+    """Human (and model) readable description of parse_card errors, used to re-prompt"""
+    return "; ".join(_PROBLEMS[error["problem"]].format(**error) for error in errors)
+
 def parse_response(text: str) -> dict:
     """Parse the LM output into a dictionary with keys:
     German, English, Example 1 (DE), Example 1 (EN), Example 2 (DE), Example 2 (EN)
     """
-    lines = [line.strip() for line in text.split("\n") if line.strip()]
-    data = {
-        "German": "",
-        "English": "",
-        "Example 1 (DE)": "",
-        "Example 1 (EN)": "",
-        "Example 2 (DE)": "",
-        "Example 2 (EN)": "",
-    }
-    for line in lines:
-        for key in data.keys():
-            prefix = key + ":"
-            if line.startswith(prefix):
-                data[key] = line[len(prefix):].strip()
+    return parse_card(text)[0]
+
+def parse_responses(text: str, words: list[str]) -> list[tuple[dict, list[dict]]]:
+    """Parse a batched LM output into one (card, errors) pair per word (see parse_card)
+
+    Cards are located by their "Card N" header lines; missing cards come back with
+    "missing" errors. Output without any headers is split on "German:" lines.
+    """
+    chunks = [""] * len(words)
+    header = re.compile(r"^\s*\**\s*Card\s+(\d+)\s*:?\s*\**\s*$", re.IGNORECASE | re.MULTILINE)
+    matches = list(header.finditer(text))
+    if matches:
+        for match, next_match in zip(matches, matches[1:] + [None]):
+            index = int(match.group(1)) - 1
+            end = next_match.start() if next_match else len(text)
+            if 0 <= index < len(words):
+                chunks[index] = text[match.end():end]
+    else:
+        found = re.split(r"^(?=\s*German:)", text, flags=re.MULTILINE)
+        found = [chunk for chunk in found if chunk.strip().startswith("German:")]
+        chunks[:len(found)] = found[:len(words)]
+    return [parse_card(chunk, word) for chunk, word in zip(chunks, words)]
+
+def card_matches_word(card: dict, word: str) -> bool:
+    """Whether a card is about the given word
+
+    An added article is fine, and so is a card for the lemma of an inflected word
+    ("ging" -> "gehen", "Häuser" -> "das Haus") as long as an example uses the word as given.
+    """
+    german = normalize_word(card.get("German", ""))
+    word = normalize_word(word)
+    if not german:
+        return False
+    if word in german or german in word:
+        return True
+    return any(word in normalize_word(card.get(key, "")) for key in ("Example 1 (DE)", "Example 2 (DE)"))
+
+class CardStreamParser:
+    """
+    Incremental card parser fed with streamed tokens
+
+    Only complete lines are inspected, so a field counts as filled once the line
+    holding it has ended. `complete` turns True as soon as every card field has been
+    seen `cards` times, which is the point where the rest of the stream can be dropped.
+    """
+
+    def __init__(self, cards=1):
+        self.cards = cards
+        self.text = ""
+        self.complete = False
+        self.first_chunk_at = None  # perf_counter() time the first token arrived
+        self._line_start = 0
+        self._counts = dict.fromkeys(REQUIRED_KEYS, 0)
+
+    def feed(self, chunk):
+        """Add streamed text; returns True once every expected card is complete"""
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self.text += chunk
+        while not self.complete:
+            end = self.text.find("\n", self._line_start)
+            if end < 0:
                 break
-    return data
+            head, colon, value = self.text[self._line_start:end].partition(":")
+            self._line_start = end + 1
+            key = _field_key(head) if colon else None
+            if key is not None and value.strip(_VALUE_NOISE):
+                self._counts[key] += 1
+            self.complete = all(count >= self.cards for count in self._counts.values())
+        return self.complete
+
+#CSV_FIELDNAMES = ["Word", "Meaning", "Example_1", "Translation_1", "Example_2", "Translation_2"]
+CSV_FIELDNAMES = ["German", "English", "Example 1 (DE)", "Example 1 (EN)", "Example 2 (DE)", "Example 2 (EN)"]
 
 def write_csv(filename: str, rows: list[dict]):
-    #fieldnames = ["Word", "Meaning", "Example_1", "Translation_1", "Example_2", "Translation_2"]
-    fieldnames = ["German", "English", "Example 1 (DE)", "Example 1 (EN)", "Example 2 (DE)", "Example 2 (EN)"]
     with open(filename, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
         writer.writeheader()
         for row in rows:
-            writer.writerow(row)
\ No newline at end of file
+            writer.writerow(row)
+
+class CardCSVWriter:
+    """Writes cards to a CSV file one row at a time, so nothing is lost if the run stops early"""
+
+    def __init__(self, filename: str, append: bool = False):
+        """
+        Args:
+            filename: CSV file path
+            append: Add rows to an existing file instead of starting a new one
+        """
+        new_file = not append or not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self.filename = filename
+        self._file = open(filename, "w" if new_file else "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=CSV_FIELDNAMES, extrasaction="ignore")
+        if new_file:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def writerow(self, row: dict):
+        self._writer.writerow(row)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
\ No newline at end of file
@@ -0,0 +1,159 @@
+import csv
+import itertools
+import os
+import sys
+
+from utils.utils import normalize_word
+
+# German articles dropped by the "articles" dedup policy ("der Hund" and "Hund" are one word)
+ARTICLES = {"der", "die", "das", "den", "dem", "des", "ein", "eine", "einen", "einem", "einer", "eines"}
+
+# How much two entries may differ and still count as the same word:
+#   exact    - identical after stripping the line
+#   case     - equal ignoring case, HTML and extra whitespace
+#   articles - like case, also ignoring a leading article
+DEDUP_POLICIES = ["none", "exact", "case", "articles"]
+
+# Whether the first row of delimited input is a header: "auto" assumes one when the column
+# is given by name, and otherwise asks csv.Sniffer about the first rows
+HEADER_MODES = ["auto", "yes", "no"]
+
+# Rows csv.Sniffer looks at to guess whether there is a header
+_SNIFF_ROWS = 50
+
+
+def word_key(word, policy="articles"):
+    """
+    Canonical key of a word under a dedup policy
+
+    Args:
+        word: Word as read from the input
+        policy: One of DEDUP_POLICIES
+
+    Returns:
+        Key that is equal for words the policy considers duplicates (None for policy "none")
+    """
+    if policy == "none":
+        return None
+    if policy == "exact":
+        return word
+    key = normalize_word(word)
+    if policy == "articles":
+        first, _, rest = key.partition(" ")
+        if rest and first in ARTICLES:
+            key = rest
+    return key
+
+
+def _open_source(path):
+    if path == "-":
+        return sys.stdin, False
+    return open(path, "r", encoding="utf-8", newline=""), True
+
+
+def _delimiter(path, delimiter):
+    if delimiter:
+        return "\t" if delimiter in ("tab", "\\t") else delimiter
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return ","
+    if extension in (".tsv", ".tab"):
+        return "\t"
+    return None
+
+
+class VocabReader:
+    """
+    Lazily reads words from a file or stdin, dropping duplicates as it goes
+
+    Plain text input has one word per line. Delimited input (.csv/.tsv, or any file with
+    an explicit delimiter) takes the words from one column, chosen by header name or by
+    1-based position; a header row is never taken for a word. Only the keys of the words
+    seen so far are kept in memory.
+    """
+
+    def __init__(self, path, column=None, delimiter=None, dedup="articles", header="auto"):
+        """
+        Args:
+            path: Vocabulary file, or "-" for stdin
+            column: Column holding the words in delimited input: a header name or a 1-based
+                index (default: the first column)
+            delimiter: Field delimiter ("," or "tab"); guessed from the file extension if not given
+            dedup: One of DEDUP_POLICIES
+            header: One of HEADER_MODES
+
+        Raises:
+            ValueError: If column is an index below 1
+        """
+        if column is not None and str(column).lstrip("-").isdigit() and int(column) < 1:
+            raise ValueError(f"Vocabulary column index must be 1 or more, got {column}")
+        self.path = path
+        self.column = column
+        self.delimiter = _delimiter(path, delimiter)
+        self.dedup = dedup
+        self.header = header
+        self.read = 0
+        self.duplicates = 0
+
+    def _raw_words(self, f):
+        if self.delimiter is None:
+            for line in f:
+                yield line.strip()
+            return
+
+        by_name = self.column is not None and not str(self.column).isdigit()
+        has_header = self.header == "yes" or (self.header == "auto" and by_name)
+        if self.header == "auto" and not by_name:
+            # Input may be stdin, so the sniffed lines are replayed instead of seeking back
+            sample = list(itertools.islice(f, _SNIFF_ROWS))
+            f = itertools.chain(sample, f)
+            try:
+                has_header = csv.Sniffer().has_header("".join(sample))
+            except csv.Error:
+                has_header = False
+
+        rows = csv.reader(f, delimiter=self.delimiter)
+        header = [name.strip() for name in next(rows, [])] if has_header else []
+        index = 0
+        if by_name:
+            if self.column not in header:
+                raise ValueError(f"Column '{self.column}' not found in {self.path} (columns: {', '.join(header)})")
+            index = header.index(self.column)
+        elif self.column is not None:
+            index = int(self.column) - 1
+        for row in rows:
+            if len(row) > index:
+                yield row[index].strip()
+
+    def __iter__(self):
+        f, close = _open_source(self.path)
+        seen = set()
+        try:
+            for word in self._raw_words(f):
+                if not word:
+                    continue
+                self.read += 1
+                key = word_key(word, self.dedup)
+                if key is not None:
+                    if key in seen:
+                        self.duplicates += 1
+                        continue
+                    seen.add(key)
+                yield word
+        finally:
+            if close:
+                f.close()
+
+
+def unique_words(words, dedup="articles"):
+    """Drop duplicates from an in-memory word list, keeping the first spelling of each word"""
+    seen = set()
+    result = []
+    for word in words:
+        key = word_key(word.strip(), dedup)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        result.append(word.strip())
+    return result